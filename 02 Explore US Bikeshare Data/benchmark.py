@@ -0,0 +1,578 @@
+import io
+import os
+import re
+import sys
+import json
+import hashlib
+import calendar
+import importlib.util
+import tracemalloc
+import numpy as np
+import pandas as pd
+import argparse as ap
+from contextlib import redirect_stdout
+from timeit import default_timer as timer
+
+import submission
+
+# the cities generated, the last one without Gender and Birth Year like the
+# washington.csv file
+CITY_SCHEMAS = (
+    {
+        'name': 'Chicago',
+        'file': 'chicago.csv',
+        'user_data': True
+    },
+    {
+        'name': 'New York City',
+        'file': 'new_york_city.csv',
+        'user_data': True
+    },
+    {
+        'name': 'Washington',
+        'file': 'washington.csv',
+        'user_data': False
+    },
+)
+
+# the rows generated and written at once
+GENERATOR_CHUNK_SIZE = 1000000
+
+# the small cities the output of submission.py is checked on and the file
+# holding the digests of the output of the baseline version
+CHECK_DATA = {'rows': 3000, 'stations': 40, 'seed': 2017}
+CHECK_EXPECTED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_expected.json')
+
+# the lines of the output that depend on the path of the file or on how it
+# was loaded, and the timings starting the other lines
+CHECK_IGNORED_LINE = re.compile(
+    r'Loaded (file|the cube)|Read the statistics|Ingested|Streamed')
+CHECK_TIMING = re.compile(r'^\(([0-9.]+s|cached)\) ')
+
+
+def generate_city_file(file_name, rows, stations, user_data, seed):
+    """Writes a CSV file with random trips in the format of the city files.
+
+    Trips start in the first six months of 2017, the stations are drawn
+    from a skewed distribution so there are popular and rare trips.
+
+    Args:
+        file_name (string): the name of the CSV file to write
+        rows (int): the number of trips to generate
+        stations (int): the number of distinct stations
+        user_data (bool): True to add the columns Gender and Birth Year
+        seed (int): the seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    station_names = np.array(
+        ['Station {:05d}'.format(station) for station in range(stations)],
+        dtype=object)
+    station_weights = 1 / np.arange(1, stations + 1)
+    station_weights /= station_weights.sum()
+    first_start = pd.Timestamp('2017-01-01')
+    seconds = int((pd.Timestamp('2017-07-01') - first_start).total_seconds())
+
+    for first_row in range(0, rows, GENERATOR_CHUNK_SIZE):
+        size = min(GENERATOR_CHUNK_SIZE, rows - first_row)
+        start_time = first_start + pd.to_timedelta(
+            rng.integers(0, seconds, size), unit='s')
+        duration = np.round(rng.lognormal(6.5, 0.8, size) + 60)
+        if not user_data:
+            # washington has durations in milliseconds
+            duration += np.round(rng.random(size), 3)
+        chunk = pd.DataFrame(
+            {
+                'Start Time':
+                start_time,
+                'End Time':
+                start_time + pd.to_timedelta(np.floor(duration), unit='s'),
+                'Trip Duration':
+                duration,
+                'Start Station':
+                station_names[rng.choice(stations, size, p=station_weights)],
+                'End Station':
+                station_names[rng.choice(stations, size, p=station_weights)],
+                'User Type':
+                np.array(['Subscriber', 'Customer',
+                          'Dependent'])[rng.choice(
+                              3, size, p=[0.8, 0.19, 0.01])],
+            },
+            index=pd.RangeIndex(first_row, first_row + size))
+        if user_data:
+            chunk['Gender'] = np.array(['Male', 'Female', None],
+                                       dtype=object)[rng.choice(
+                                           3, size, p=[0.65, 0.25, 0.1])]
+            birth_year = rng.integers(1920, 2002, size).astype('float64')
+            birth_year[rng.random(size) < 0.1] = np.nan
+            chunk['Birth Year'] = birth_year
+        chunk.to_csv(
+            file_name, mode='w' if first_row == 0 else 'a',
+            header=first_row == 0)
+    # --------------------------------------------------- generate_city_file()
+
+
+def generate_data(data_dir, rows, stations, seed):
+    """Generates all city files unless they exist with the wanted size.
+
+    A file named data.json in the data directory remembers the parameters
+    the files were generated with.
+
+    Args:
+        data_dir (string): the directory to write the files to
+        rows (int): the number of trips per city
+        stations (int): the number of distinct stations per city
+        seed (int): the seed of the random generator
+
+    Returns:
+        list: the city dicts in the format of the city_data option of
+              submission.py
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    parameters = {'rows': rows, 'stations': stations, 'seed': seed}
+    parameters_file = os.path.join(data_dir, 'data.json')
+    city_data = [
+        {
+            'name': schema['name'],
+            'file': os.path.join(data_dir, schema['file'])
+        } for schema in CITY_SCHEMAS
+    ]
+
+    try:
+        with open(parameters_file) as file:
+            up_to_date = json.load(file) == parameters
+    except (OSError, ValueError):
+        up_to_date = False
+    if up_to_date and all(
+            os.path.exists(city_dict['file']) for city_dict in city_data):
+        return city_data
+
+    for schema, city_dict in zip(CITY_SCHEMAS, city_data):
+        print('Generating {} trips for {} ...'.format(rows, city_dict['name']))
+        generate_city_file(city_dict['file'], rows, stations,
+                           schema['user_data'], seed + len(city_dict['name']))
+    with open(parameters_file, 'w') as file:
+        json.dump(parameters, file)
+    return city_data
+    # -------------------------------------------------------- generate_data()
+
+
+def get_options(city_data):
+    """Returns the default options of submission.py for the generated cities
+    without interaction and caches.
+
+    Args:
+        city_data (list): the generated cities
+
+    Returns:
+        dict: the options analyzing the first city without any filter
+    """
+    options = submission.create_options(tuple(city_data))
+    options['interactive'] = False
+    options['cache_dir'] = None
+    return options
+    # ---------------------------------------------------------- get_options()
+
+
+def measure(function_name, *args, repeat=1, prepare=None):
+    """Measures the best time of several runs of a function and the peak
+    memory of one additional run traced by tracemalloc.
+
+    Args:
+        function_name (function): the function to measure
+        *args: Variable length argument list which is passed to the function
+        repeat (int): the number of timed runs
+        prepare (function): called without arguments before every run, e.g.
+                            to remove a cache
+
+    Returns:
+        dict: the keys seconds and peak_memory (bytes)
+    """
+    seconds = []
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        start_time = timer()
+        function_name(*args)
+        seconds.append(timer() - start_time)
+
+    if prepare is not None:
+        prepare()
+    tracemalloc.start()
+    try:
+        function_name(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_memory': peak_memory}
+    # -------------------------------------------------------------- measure()
+
+
+def get_helper_benchmarks():
+    """Returns the statistic helpers of submission.py and their arguments.
+
+    Returns:
+        list: tuples of the name of the benchmark, the helper and the
+              arguments following the DataFrame
+    """
+    trip_fields = ['Start Station', 'End Station']
+    return [
+        ('most common month', submission.get_most_common_value, ('Month', )),
+        ('most common start station', submission.get_most_common_value,
+         ('Start Station', )),
+        ('most common trip', submission.get_nlargest_by_group,
+         (trip_fields, 1)),
+        ('most unpopular trip', submission.get_nsmallest_by_group,
+         (trip_fields, 1)),
+        ('total duration', submission.get_total, ('Trip Duration', )),
+        ('average duration', submission.get_average, ('Trip Duration', )),
+        ('shortest trip', submission.get_min_index, ('Trip Duration', )),
+        ('user types', submission.get_value_counts, ('User Type', )),
+        ('user type ratio', submission.get_ratio, ('User Type', )),
+        ('men start station', submission.get_max_of_group,
+         (['Gender', 'Start Station'], 'Gender', 'Male')),
+        ('oldest', submission.get_min, ('Birth Year', )),
+        ('most common birth year', submission.get_most_common_value,
+         ('Birth Year', )),
+    ]
+    # ------------------------------------------------ get_helper_benchmarks()
+
+
+def run_benchmarks(city_data, rows, cache_dir, repeat):
+    """Runs all benchmarks on the generated data.
+
+    Args:
+        city_data (list): the generated cities
+        rows (int): the number of trips per city
+        cache_dir (string): the directory to write the caches to
+        repeat (int): the number of timed runs per benchmark
+
+    Returns:
+        dict: the results per benchmark holding rows, seconds,
+              rows_per_second and peak_memory
+    """
+    results = {}
+
+    def add_result(name, result_rows, result):
+        result['rows'] = result_rows
+        result['rows_per_second'] = result_rows / result['seconds']
+        results[name] = result
+        print('{:<40} {:>12.4f}s {:>14,.0f} rows/s {:>10.1f} MB'.format(
+            name, result['seconds'], result['rows_per_second'],
+            result['peak_memory'] / 2**20))
+
+    def remove_cache():
+        cache_path = submission.get_cache_path(city_dict['file'], cache_dir)
+        meta_file = os.path.join(cache_path, 'meta.json')
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+
+    city_dict = city_data[0]
+    options = get_options(city_data)
+
+    # loading
+    add_result('load_data (csv)', rows,
+               measure(submission.load_data, options, repeat=repeat))
+    options['cache_dir'] = cache_dir
+    add_result(
+        'load_data (write cache)', rows,
+        measure(
+            submission.load_data, options, repeat=repeat,
+            prepare=remove_cache))
+    add_result('load_data (read cache)', rows,
+               measure(submission.load_data, options, repeat=repeat))
+    options['filter_type'] = 'Both'
+    add_result('load_data (filter both)', rows,
+               measure(submission.load_data, options, repeat=repeat))
+    options['filter_type'] = None
+    options['session'] = submission.create_session(
+        submission.SESSION_MEMORY_BUDGET)
+    submission.load_data(options)
+    options['filter_type'] = 'Both'
+    add_result('load_data (session filter both)', rows,
+               measure(submission.load_data, options, repeat=repeat))
+    options['filter_type'] = None
+    options['session'] = None
+
+    # the statistics read from the result cache without loading the data
+    options['result_cache'] = True
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        submission.analyze(options)
+        result = measure(submission.analyze, options, repeat=repeat)
+    add_result('analyze (result cache)', rows, result)
+    options['result_cache'] = False
+
+    # statistics
+    city_df = submission.load_data(options)
+    for name, helper, args in get_helper_benchmarks():
+        add_result(name, rows,
+                   measure(helper, city_df, *args, repeat=repeat))
+    add_result(
+        'calculate_statistics', rows,
+        measure(
+            submission.calculate_statistics, city_df, options, repeat=repeat))
+    add_result('build_aggregates', rows,
+               measure(submission.build_aggregates, city_df, repeat=repeat))
+    options['cube'] = True
+    add_result('load_cube', rows,
+               measure(submission.load_cube, options, repeat=repeat))
+    options['filter_type'] = 'Both'
+    add_result(
+        'calculate_aggregated_statistics (both)', rows,
+        measure(submission.calculate_aggregated_statistics,
+                submission.load_cube(options), options, repeat=repeat))
+    options['filter_type'] = None
+    options['cube'] = False
+
+    # the full test sweep over all cities
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        result = measure(submission.test, options, repeat=repeat)
+    add_result('test', rows * len(city_data), result)
+
+    return results
+    # ------------------------------------------------------- run_benchmarks()
+
+
+def compare_results(results, baseline, tolerance):
+    """Prints the change of every benchmark against a stored baseline.
+
+    Args:
+        results (dict): the results of run_benchmarks()
+        baseline (dict): the results of an earlier run
+        tolerance (float): the relative slowdown still accepted
+
+    Returns:
+        int: the number of benchmarks slower than the tolerance allows
+    """
+    regressions = 0
+    print('\nCompared to the baseline:')
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:<40} {:>12}'.format(name, 'new'))
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds']
+        memory_ratio = result['peak_memory'] / max(
+            baseline[name]['peak_memory'], 1)
+        slower = ratio > 1 + tolerance
+        regressions += slower
+        print('{:<40} {:>11.2f}x time {:>7.2f}x memory{}'.format(
+            name, ratio, memory_ratio, '  SLOWER' if slower else ''))
+    return regressions
+    # ------------------------------------------------------ compare_results()
+
+
+def analyze_sweep(analyze_function, options):
+    """Calls an analyze function for every filter combination of every city
+    in the order and with the headers of submission.test().
+
+    Args:
+        analyze_function (function): analyze() of submission.py or of an
+                                     older version of it
+        options (dict): the options passed to analyze_function, all cities
+                        of city_data are analyzed
+    """
+    options['interactive'] = False
+    for city_dict in options['city_data']:
+        print('-' * 80)
+        print('Analyzing data for city "{}" ..'.format(city_dict['name']))
+        options['city_of_interest'] = city_dict
+        options['filter_type'] = None
+        analyze_function(options)
+        for month in options['allowed_months']:
+            print('-' * 80)
+            print('Analyzing again using Filter "Month" for "{}" ..'.format(
+                calendar.month_name[month]))
+            options['filter_type'] = 'Month'
+            options['month_of_interest'] = month
+            analyze_function(options)
+            for day in options['allowed_days']:
+                print('-' * 80)
+                print(
+                    'Analyzing again using Filter "Both" for "{}" and "{}" ..'.
+                    format(calendar.month_name[month], calendar.day_name[day]))
+                options['filter_type'] = 'Both'
+                options['day_of_interest'] = day
+                analyze_function(options)
+        for day in options['allowed_days']:
+            print('-' * 80)
+            print('Analyzing again using Filter "Day" for "{}" ..'.format(
+                calendar.day_name[day]))
+            options['filter_type'] = 'Day'
+            options['day_of_interest'] = day
+            analyze_function(options)
+    # -------------------------------------------------------- analyze_sweep()
+
+
+def get_output_digests(function_name, *args):
+    """Calls a function and returns the SHA-1 digests of the sections of
+    its output, without timings and the lines naming the file loaded.
+
+    Args:
+        function_name (function): the function printing the sections, each
+                                  started by a line of dashes and a header
+        *args: Variable length argument list which is passed to the function
+
+    Returns:
+        dict: the digests by city and header of the section
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        function_name(*args)
+
+    digests = {}
+    city = None
+    for section in output.getvalue().split('-' * 80 + '\n')[1:]:
+        lines = section.splitlines()
+        if lines[0].startswith('Analyzing data for city'):
+            city = lines[0]
+        text = '\n'.join(
+            CHECK_TIMING.sub('', line) for line in lines
+            if not CHECK_IGNORED_LINE.search(line))
+        digests['{} / {}'.format(city, lines[0])] = hashlib.sha1(
+            text.encode()).hexdigest()
+    return digests
+    # --------------------------------------------------- get_output_digests()
+
+
+def check_output(data_dir, baseline_file=None):
+    """Checks that test() and analyze() of submission.py print the same
+    statistics as the baseline version on small generated cities.
+
+    Args:
+        data_dir (string): the directory to generate the cities in
+        baseline_file (string): the submission.py of the baseline version
+                                to store the expected digests of, instead
+                                of checking
+
+    Returns:
+        int: the number of sections printed differently
+    """
+    data_dir = os.path.join(data_dir, 'check')
+    city_data = generate_data(data_dir, CHECK_DATA['rows'],
+                              CHECK_DATA['stations'], CHECK_DATA['seed'])
+    options = get_options(city_data)
+
+    if baseline_file is not None:
+        spec = importlib.util.spec_from_file_location('baseline',
+                                                      baseline_file)
+        baseline = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(baseline)
+        expected = get_output_digests(analyze_sweep, baseline.analyze,
+                                      options)
+        with open(CHECK_EXPECTED_FILE, 'w') as file:
+            json.dump(expected, file, indent=2)
+        print('Stored {} digests.'.format(len(expected)))
+        return 0
+
+    with open(CHECK_EXPECTED_FILE) as file:
+        expected = json.load(file)
+    cache_dir = os.path.join(data_dir, 'cache')
+    runs = (
+        ('test (aggregated)', submission.test, dict(options)),
+        ('analyze', analyze_sweep, submission.analyze, dict(options)),
+        ('analyze (cache)', analyze_sweep, submission.analyze,
+         dict(options, cache_dir=cache_dir)),
+        ('analyze (store results)', analyze_sweep, submission.analyze,
+         dict(options, cache_dir=cache_dir, result_cache=True)),
+        ('analyze (read results)', analyze_sweep, submission.analyze,
+         dict(options, cache_dir=cache_dir, result_cache=True)),
+        ('analyze (stream)', analyze_sweep, submission.analyze,
+         dict(options, stream=True)),
+        ('analyze (cube)', analyze_sweep, submission.analyze,
+         dict(options, cache_dir=cache_dir, cube=True)),
+        ('analyze (incremental)', analyze_sweep, submission.analyze,
+         dict(options, cache_dir=cache_dir, incremental=True)),
+    )
+    differences = 0
+    for name, function_name, *args in runs:
+        digests = get_output_digests(function_name, *args)
+        different = [
+            section for section in expected
+            if digests.get(section) != expected[section]
+        ]
+        differences += len(different)
+        print('{:<40} {:>4} of {} sections differ'.format(
+            name, len(different), len(expected)))
+        for section in different[:5]:
+            print('    ' + section)
+    return differences
+    # --------------------------------------------------------- check_output()
+
+
+def parse_arguments():
+    """Parses the command line arguments of the benchmark."""
+    arg_parser = ap.ArgumentParser(
+        prog='bikeshare-benchmark',
+        description='Benchmarks submission.py on synthetic bikeshare data.',
+        formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument(
+        '--rows',
+        help='The number of trips per city, e.g. 1e5 to 1e8.',
+        type=lambda value: int(float(value)),
+        default=100000)
+    arg_parser.add_argument(
+        '--stations',
+        help='The number of distinct stations per city.',
+        type=int,
+        default=600)
+    arg_parser.add_argument(
+        '--seed', help='The seed of the generator.', type=int, default=2017)
+    arg_parser.add_argument(
+        '--data-dir',
+        help='The directory for the generated files and caches.',
+        default='benchmark_data')
+    arg_parser.add_argument(
+        '--repeat',
+        help='The number of timed runs per benchmark.',
+        type=int,
+        default=3)
+    arg_parser.add_argument(
+        '--output', help='Store the results as JSON in this file.')
+    arg_parser.add_argument(
+        '--baseline', help='Compare the results to this JSON file.')
+    arg_parser.add_argument(
+        '--check',
+        help='Only check that the statistics printed equal the ones of the '
+        'baseline version on small generated cities.',
+        action='store_true')
+    arg_parser.add_argument(
+        '--store-expected',
+        metavar='BASELINE_SUBMISSION',
+        help='Store the digests the check expects from the output of this '
+        'baseline version of submission.py.')
+    arg_parser.add_argument(
+        '--tolerance',
+        help='The relative slowdown accepted when comparing.',
+        type=float,
+        default=0.1)
+    return arg_parser.parse_args()
+    # ------------------------------------------------------ parse_arguments()
+
+
+# Start main -----------------------------------------------------------------
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.check or args.store_expected:
+        if check_output(args.data_dir, args.store_expected):
+            sys.exit(1)
+        sys.exit(0)
+
+    data_dir = os.path.join(args.data_dir, '{}x{}'.format(
+        args.rows, args.stations))
+    city_data = generate_data(data_dir, args.rows, args.stations, args.seed)
+
+    print('Benchmarking {} rows per city ({}, {} stations):'.format(
+        args.rows, calendar.month_name[1] + ' - ' + calendar.month_name[6],
+        args.stations))
+    results = run_benchmarks(city_data, args.rows,
+                             os.path.join(data_dir, 'cache'), args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,14 +1,179 @@
+import io
 import os
+import csv
 import sys
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
 import calendar
+import cProfile
+import tracemalloc
+import numpy as np
 import pandas as pd
 import argparse as ap
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from timeit import default_timer as timer
 
+# version of the on-disk layout written by write_cache(). Bump it whenever
+# the stored columns or their types change, so old caches are rebuilt.
+CACHE_FORMAT_VERSION = 3
+
+# the partition indexes written to the cache, mapping their name to the
+# fields the rows are grouped by
+PARTITION_INDEXES = {
+    'month': ['Month'],
+    'weekday': ['Weekday'],
+    'month_weekday': ['Month', 'Weekday'],
+}
+
+# the fields the aggregates are partitioned by. Every filter selects a set of
+# these partitions.
+PARTITION_FIELDS = ['Month', 'Weekday']
+
+# the field combinations counted per partition by build_aggregates(). The
+# empty combination counts the rows of each partition.
+AGGREGATED_FIELDS = (
+    (),
+    ('Start Hour', ),
+    ('End Hour', ),
+    ('Start Station', ),
+    ('End Station', ),
+    ('Start Station', 'End Station'),
+    ('User Type', ),
+    ('Gender', ),
+    ('Gender', 'Start Station'),
+    ('Gender', 'Start Hour'),
+    ('Birth Year', ),
+)
+
+# the station fields summarized by bounded-memory sketches instead of being
+# counted exactly in approximate mode. The number of station pairs grows with
+# the square of the number of stations.
+SKETCHED_FIELDS = (
+    ('Start Station', ),
+    ('End Station', ),
+    ('Start Station', 'End Station'),
+)
+
+# the memory in bytes the interactive menu may use to keep loaded city data
+# in its session, see create_session()
+SESSION_MEMORY_BUDGET = 2 * 1024**3
+
+# the bytes the statistics stored by write_results() may use and the
+# seconds they are kept at most. The least recently used are removed first.
+RESULT_CACHE_SIZE = 64 * 1024**2
+RESULT_CACHE_AGE = 7 * 24 * 3600
+
+# the bytes before the ingested end of a city file whose hash is stored by
+# ingest_aggregates() to notice that the file was rewritten instead of
+# appended to
+INGEST_CHECK_SIZE = 64 * 1024
+
+# the fields of every span recorded by timed_span(), in the order they are
+# exported
+SPAN_FIELDS = ('id', 'parent', 'depth', 'name', 'rows', 'wall_time',
+               'cpu_time', 'start_memory', 'peak_memory', 'memory_delta')
+
+# the spans recorded so far in the order they were started or None to not
+# record them, the lock guarding them and the spans currently open in every
+# thread, the innermost one last. Spans are only recorded while a command
+# exporting them runs, see run_instrumented().
+instrumentation = {
+    'spans': None,
+    'lock': threading.Lock(),
+    'threads': threading.local()
+}
+
+
+@contextmanager
+def timed_span(name):
+    """Records the time and memory used by the enclosed block as span.
+
+    Spans opened while another span of the same thread is open become its
+    children, so the recorded spans form a tree (e.g. load, parse, derive,
+    filter). Memory is only measured while tracemalloc is tracing, it is
+    shared by all threads.
+
+    Args:
+        name (string): the name of the span
+
+    Yields:
+        dict: the span holding the fields of SPAN_FIELDS. The enclosed block
+              may set rows, the timing fields are set on exit.
+    """
+    threads = instrumentation['threads']
+    if not hasattr(threads, 'stack'):
+        threads.stack = []
+    stack = threads.stack
+    span = dict.fromkeys(SPAN_FIELDS)
+    span.update({
+        'parent': stack[-1]['id'] if stack else None,
+        'depth': len(stack),
+        'name': name,
+    })
+    with instrumentation['lock']:
+        if instrumentation['spans'] is not None:
+            span['id'] = len(instrumentation['spans'])
+            instrumentation['spans'].append(span)
+
+    if tracemalloc.is_tracing():
+        # keep the peak of the open spans before resetting it for this one
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        for open_span in stack:
+            open_span['peak_memory'] = max(open_span['peak_memory'],
+                                           peak_memory)
+        tracemalloc.reset_peak()
+        span['start_memory'] = span['peak_memory'] = current_memory
+
+    stack.append(span)
+    start_time = timer()
+    start_cpu_time = time.process_time()
+    try:
+        yield span
+    finally:
+        span['wall_time'] = timer() - start_time
+        span['cpu_time'] = time.process_time() - start_cpu_time
+        stack.pop()
+        if tracemalloc.is_tracing() and span['start_memory'] is not None:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            for open_span in stack + [span]:
+                open_span['peak_memory'] = max(open_span['peak_memory'],
+                                               peak_memory)
+            span['memory_delta'] = span['peak_memory'] - span['start_memory']
+    # ----------------------------------------------------------- timed_span()
+
+
+def get_span_name(function_name, args):
+    """Returns the name of the span of a calculation, made of the name of
+    the function and its simple arguments like field names.
+
+    Args:
+        function_name (function): the function called
+        args (tuple): the arguments the function is called with
+
+    Returns:
+        string: e.g. "get_most_common_value('Start Hour')"
+    """
+    return '{}({})'.format(
+        function_name.__name__, ', '.join(
+            repr(arg) for arg in args
+            if isinstance(arg, (str, int, float, tuple, list))))
+    # -------------------------------------------------------- get_span_name()
+
 
 def timed_calculation(function_name, *args):
     """Calculates a statistic and measures the time it took to do it.
 
+    The calculation is recorded as span, see timed_span(). The rows
+    processed are the rows of the first DataFrame passed or returned.
+
     Args:
         function_name (function): the function to call
         *args: Variable length argument list which is passed to the called
@@ -16,23 +181,124 @@ def timed_calculation(function_name, *args):
     Returns:
         tuple: a tuple with the result and the time the calculation took
     """
-    start_time = timer()
-    result = function_name(*args)
-    return (result, timer() - start_time)
+    with timed_span(get_span_name(function_name, args)) as span:
+        result = function_name(*args)
+        for value in args + (result, ):
+            if isinstance(value, pd.DataFrame):
+                span['rows'] = len(value)
+                break
+    return (result, span['wall_time'])
     # ---------------------------------------------------- timed_calculation()
 
 
-def get_most_common_value(data_frame, field):
+def export_spans(file_name):
+    """Writes the recorded spans to a file. Files ending with .csv get one
+    row per span, all other files a JSON document.
+
+    Args:
+        file_name (string): the name of the file to write
+    """
+    spans = instrumentation['spans']
+    if file_name.lower().endswith('.csv'):
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=SPAN_FIELDS)
+            writer.writeheader()
+            writer.writerows(spans)
+    else:
+        with open(file_name, 'w') as file:
+            json.dump({'spans': spans}, file, indent=2)
+    # --------------------------------------------------------- export_spans()
+
+
+def run_instrumented(action, options):
+    """Runs an action with the profiling requested in the options and
+    exports the recorded spans afterwards. Spans are only recorded if they
+    are exported, starting with none.
+
+    Args:
+        action (function): the function to call with the options
+        options (dict): dictionary holding at least
+                        - timings_file: the file to export the spans to
+                        - profile_file: the file to write cProfile stats to
+                        - trace_memory: True to measure memory of the spans
+    """
+    if options['timings_file']:
+        instrumentation['spans'] = []
+    if options['trace_memory']:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if options['profile_file'] else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        action(options)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options['profile_file'])
+        if options['timings_file']:
+            export_spans(options['timings_file'])
+            instrumentation['spans'] = None
+        if options['trace_memory']:
+            tracemalloc.stop()
+    # ----------------------------------------------------- run_instrumented()
+
+
+def get_planned(plan, key, function_name, *args):
+    """Returns a result shared by several statistics. The result is
+    calculated on first use and stored in the plan, so every distinct
+    grouping or value count is calculated only once per run.
+
+    Args:
+        plan (dict): the results calculated so far or None to not share
+                     the result
+        key (tuple): the key identifying the calculation in the plan
+        function_name (function): the function to call if the result is
+                                  not yet in the plan
+        *args: Variable length argument list which is passed to the called
+               function
+
+    Returns:
+        the result of the function
+    """
+    if plan is None:
+        return function_name(*args)
+    if key not in plan:
+        plan[key] = function_name(*args)
+    return plan[key]
+    # ---------------------------------------------------------- get_planned()
+
+
+def get_group_sizes(data_frame, field_list, plan=None):
+    """Groups a DataFrame by a list of fields and counts the rows per group.
+
+    Args:
+        data_frame (DataFrame): the Pandas DataFrame to group
+        field_list (list): the list of fields to group by
+        plan (dict): the plan to share the result with other statistics
+
+    Returns:
+        Series: the size of each group, sorted by the fields
+    """
+    return get_planned(plan, ('group_sizes', ) + tuple(field_list),
+                       lambda: data_frame.groupby(field_list,
+                                                  observed=True).size())
+    # ------------------------------------------------------ get_group_sizes()
+
+
+def get_most_common_value(data_frame, field, plan=None):
     """Calculates the most common value (mode) of a field in a given DataFrame.
 
+    Like Series.mode() the smallest value wins a tie.
+
     Args:
         data_frame (DataFrame):  the Pandas DataFrame to analyze
         field (string): the field to calculate the modal from
+        plan (dict): the plan to share the group sizes with
 
     Returns:
         Series: the most common value of the field
     """
-    return data_frame[field].mode()[0]
+    return get_group_sizes(data_frame, [field], plan).idxmax()
     # ------------------------------------------------ get_most_common_value()
 
 
@@ -64,36 +330,47 @@ def get_average(data_frame, field):
     # ---------------------------------------------------------  get_average()
 
 
-def get_value_counts(data_frame, field):
+def get_value_counts(data_frame, field, plan=None):
     """Calculates the value count of a given field in a given DataFrame.
 
     Args:
         data_frame (DataFrame): the Pandas DataFrame to analyze
         field (string): the field to calculate the values of
+        plan (dict): the plan to share the value count with
 
     Returns:
         Series: a Pandas Series representing the count of distinct values
     """
-    return data_frame[field].value_counts()
+
+    def value_counts():
+        # categories not found in the data are dropped and equal counts are
+        # ordered by first appearance like they are for plain text columns
+        column = data_frame[field].dropna()
+        return column.value_counts().reindex(column.unique()).sort_values(
+            ascending=False, kind='mergesort')
+
+    return get_planned(plan, ('value_counts', field), value_counts)
     # ----------------------------------------------------- get_value_counts()
 
 
-def get_ratio(data_frame, field):
+def get_ratio(data_frame, field, plan=None):
     """Calculates the ratio of the values of a given field of a DataFrame.
 
     Args:
         data_frame (DataFrame): a Pandas DataFrame to analyze
         field (string): the field to calculate the values of
+        plan (dict): the plan to share the value count with
 
     Returns:
         Series: Pandas Series representing the count of distinct values as
                 ratio
     """
-    return data_frame[field].value_counts(normalize=True) * 100
+    value_counts = get_value_counts(data_frame, field, plan)
+    return value_counts / value_counts.sum() * 100
     # ------------------------------------------------------------ get_ratio()
 
 
-def get_nlargest_by_group(data_frame, field_list, top_n):
+def get_nlargest_by_group(data_frame, field_list, top_n, plan=None):
     """Calculates the most common value of a field combination by
     grouping the dataframe by a given list of fields, and calculating the
     largest group.
@@ -102,16 +379,17 @@ def get_nlargest_by_group(data_frame, field_list, top_n):
         data_frame (DataFrame): the Pandas DataFrame to group and analyze
         field_list (list): the list of fields to group by
         top_n (int) the number for the top n results
+        plan (dict): the plan to share the group sizes with
 
     Returns:
         DataFrame: The DataFrame containing the Top N result
     """
-    return data_frame.groupby(field_list).size().nlargest(top_n).reset_index(
-        name='count')
+    return get_group_sizes(data_frame, field_list,
+                           plan).nlargest(top_n).reset_index(name='count')
     # ------------------------------------------------ get_nlargest_by_group()
 
 
-def get_nsmallest_by_group(data_frame, field_list, top_n):
+def get_nsmallest_by_group(data_frame, field_list, top_n, plan=None):
     """Calculates the least common value of a field combination by
     grouping the dataframe by a given list of fields, and calculating the
     smallest group.
@@ -120,16 +398,21 @@ def get_nsmallest_by_group(data_frame, field_list, top_n):
         data_frame (DataFrame): the Pandas DataFrame to group and analyze
         field_list (list): the list of fields to group by
         top_n (int) the number for the top n results of the smallest group
+        plan (dict): the plan to share the group sizes with
 
     Returns:
         DataFrame: The DataFrame containing the Top N result
     """
-    return data_frame.groupby(field_list).size().nsmallest(top_n).reset_index(
-        name='count')
+    return get_group_sizes(data_frame, field_list,
+                           plan).nsmallest(top_n).reset_index(name='count')
     # ----------------------------------------------- get_nsmallest_by_group()
 
 
-def get_max_of_group(data_frame, field_list, group_name, group_value):
+def get_max_of_group(data_frame,
+                     field_list,
+                     group_name,
+                     group_value,
+                     plan=None):
     """Groups a DataFrame by a list of fields, creates a new column with the
     count of values per group and returns the maximum value of given field in
     a given group.
@@ -139,12 +422,13 @@ def get_max_of_group(data_frame, field_list, group_name, group_value):
         field_list (list): the list of fields to group by
         group_name (String): the name of the Group the max value is searched in
         group_value (Object): the value the Group should be filtered by
+        plan (dict): the plan to share the group sizes with
 
     Returns:
         the maximum value in the given group
     """
-    grouped_df = data_frame.groupby(field_list).size().reset_index(
-        name='count')
+    grouped_df = get_group_sizes(data_frame, field_list,
+                                 plan).reset_index(name='count')
     group_df = grouped_df[grouped_df[group_name] == group_value].reset_index()
     max_index = get_max_index(group_df, 'count')
     return get_row_by_index(group_df, max_index)
@@ -221,71 +505,1774 @@ def get_row_by_index(data_frame, index):
     # ----------------------------------------------------- get_row_by_index()
 
 
+def read_city_file(file_name):
+    """Reads a city CSV file and adds the derived time columns.
+
+    Args:
+        file_name (string): the name of the CSV file to read
+
+    Returns:
+        DataFrame: the unfiltered city data including the columns Month,
+                   Weekday, Start Hour and End Hour
+    """
+
+    # load data file into a dataframe
+    # as we know the format in advance we will convert columns 1 and 2 to
+    # datetime
+    with timed_span('parse') as span:
+        df = pd.read_csv(file_name, parse_dates=[1, 2])
+        span['rows'] = len(df)
+    return prepare_city_data(df)
+    # ------------------------------------------------------- read_city_file()
+
+
+def read_city_file_chunks(file_name, chunk_size):
+    """Reads a city CSV file in chunks and adds the derived time columns to
+    every chunk. The rows keep their labels across the chunks.
+
+    Args:
+        file_name (string): the name of the CSV file to read
+        chunk_size (int): the number of rows per chunk
+
+    Returns:
+        generator: yields the chunks as DataFrames, none if the file holds
+                   no rows
+    """
+    try:
+        chunks = pd.read_csv(file_name, parse_dates=[1, 2],
+                             chunksize=chunk_size)
+    except pd.errors.EmptyDataError:
+        return
+    while True:
+        with timed_span('parse') as span:
+            chunk = next(chunks, None)
+            span['rows'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        if not chunk.empty:
+            yield prepare_city_data(chunk)
+    # ------------------------------------------------ read_city_file_chunks()
+
+
+def prepare_city_data(df):
+    """Drops the unnamed first column of the raw city data and adds the
+    derived time columns.
+
+    Args:
+        df (DataFrame): the data as read from the CSV file
+
+    Returns:
+        DataFrame: the city data including the columns Month, Weekday,
+                   Start Hour and End Hour
+    """
+
+    with timed_span('derive') as span:
+        span['rows'] = len(df)
+
+        # drop the first column to remove the unnamed column that exists in
+        # the csv files
+        df = df.drop(df.columns[0], axis=1)
+
+        # create new columns having month, weekday, and start hour
+        df['Month'] = df['Start Time'].dt.month
+        df['Weekday'] = df['Start Time'].dt.weekday
+        df['Start Hour'] = df['Start Time'].dt.hour
+        df['End Hour'] = df['End Time'].dt.hour
+
+        return narrow_types(df)
+    # ---------------------------------------------------- prepare_city_data()
+
+
+def narrow_types(data_frame):
+    """Converts the columns of city data to compact types.
+
+    The text columns become categories, the derived time columns int8 and
+    the birth year float32, which holds every year exactly. The trip
+    duration stays float64 as its sum and mean are printed with nanosecond
+    precision.
+
+    Args:
+        data_frame (DataFrame): the city data
+
+    Returns:
+        DataFrame: the city data using the compact types
+    """
+    for field in ('Start Station', 'End Station', 'User Type', 'Gender'):
+        if field in data_frame:
+            data_frame[field] = data_frame[field].astype('category')
+    for field in ('Month', 'Weekday', 'Start Hour', 'End Hour'):
+        data_frame[field] = data_frame[field].astype('int8')
+    if 'Birth Year' in data_frame:
+        data_frame['Birth Year'] = data_frame['Birth Year'].astype('float32')
+    return data_frame
+    # --------------------------------------------------------- narrow_types()
+
+
+def get_file_fingerprint(file_name):
+    """Returns the size and modification time of a file.
+
+    Args:
+        file_name (string): the name of the file
+
+    Returns:
+        dict: a dictionary holding the keys size and mtime_ns
+    """
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    # ------------------------------------------------- get_file_fingerprint()
+
+
+def get_file_hash(file_name):
+    """Calculates the SHA-1 hash of the content of a file.
+
+    Args:
+        file_name (string): the name of the file
+
+    Returns:
+        string: the hex digest of the file content
+    """
+    file_hash = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+    # -------------------------------------------------------- get_file_hash()
+
+
+def get_cache_path(file_name, cache_dir):
+    """Returns the directory the cache of a city file is stored in. It is
+    named after the file and a hash of its absolute path, so files of the
+    same name in different directories do not share a cache.
+
+    Args:
+        file_name (string): the name of the CSV file
+        cache_dir (string): the directory holding all caches
+
+    Returns:
+        string: the path of the cache directory for the given file
+    """
+    path_hash = hashlib.sha1(os.path.abspath(file_name).encode()).hexdigest()
+    return os.path.join(
+        cache_dir, '{}_{}'.format(
+            os.path.splitext(os.path.basename(file_name))[0], path_hash[:12]))
+    # ------------------------------------------------------- get_cache_path()
+
+
+def build_partition_index(data_frame, field_list):
+    """Groups the row positions of a DataFrame by the values of the given
+    fields. Within a group the positions keep the order of the rows.
+
+    Args:
+        data_frame (DataFrame): the unfiltered city data
+        field_list (list): the small integer fields to group by
+
+    Returns:
+        tuple: the row positions sorted by group and a dict mapping the key
+               of every group ("month" or "month,weekday") to the start and
+               stop offset of its positions
+    """
+    keys = np.zeros(len(data_frame), dtype='int64')
+    for field in field_list:
+        keys = keys * 100 + data_frame[field].values
+    positions = np.argsort(keys, kind='stable')
+    if len(positions) < 2**31:
+        positions = positions.astype('int32')
+
+    groups, starts, counts = np.unique(
+        keys[positions], return_index=True, return_counts=True)
+    offsets = {}
+    for group, start, count in zip(groups, starts, counts):
+        values = [(group // 100**power) % 100
+                  for power in reversed(range(len(field_list)))]
+        offsets[','.join(str(value) for value in values)] = [
+            int(start), int(start + count)
+        ]
+    return positions, offsets
+    # ------------------------------------------------ build_partition_index()
+
+
+def write_cache(data_frame, cache_path, file_name):
+    """Writes a DataFrame as columnar binary cache of a city file.
+
+    Every column is stored as a plain numpy array in its own .npy file, so
+    it can be memory mapped when read again. Categorical columns are stored
+    as integer codes and their categories are kept in the file meta.json,
+    datetime columns are stored as int64 nanoseconds.
+
+    In addition the partition indexes of PARTITION_INDEXES are written, so
+    filtered rows can be found without scanning the data.
+
+    The meta data is removed first and written last, so an interrupted
+    write never leaves a cache behind that looks valid.
+
+    Args:
+        data_frame (DataFrame): the data read by read_city_file()
+        cache_path (string): the directory to write the cache to
+        file_name (string): the name of the CSV file the data was read from
+
+    Returns:
+        dict: the partition indexes as returned by read_cache()
+    """
+    meta_file = os.path.join(cache_path, 'meta.json')
+    os.makedirs(cache_path, exist_ok=True)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    columns = []
+    for position, column in enumerate(data_frame.columns):
+        series = data_frame[column]
+        column_meta = {'name': column, 'file': '{:02d}.npy'.format(position)}
+        if pd.api.types.is_datetime64_any_dtype(series):
+            column_meta['kind'] = 'datetime'
+            values = series.values.astype('datetime64[ns]').view('int64')
+        elif pd.api.types.is_numeric_dtype(series):
+            column_meta['kind'] = 'numeric'
+            values = series.values
+        else:
+            column_meta['kind'] = 'category'
+            series = series.astype('category')
+            column_meta['categories'] = [
+                str(value) for value in series.cat.categories
+            ]
+            values = series.cat.codes.values.astype('int32')
+        np.save(os.path.join(cache_path, column_meta['file']), values)
+        columns.append(column_meta)
+
+    partitions = {}
+    for name, field_list in PARTITION_INDEXES.items():
+        positions, offsets = build_partition_index(data_frame, field_list)
+        np.save(os.path.join(cache_path, 'index_' + name + '.npy'), positions)
+        partitions[name] = {'positions': positions, 'offsets': offsets}
+
+    meta = {
+        'version': CACHE_FORMAT_VERSION,
+        'source': dict(get_file_fingerprint(file_name),
+                       sha1=get_file_hash(file_name)),
+        'rows': len(data_frame),
+        'columns': columns,
+        'partitions': {
+            name: partition['offsets']
+            for name, partition in partitions.items()
+        },
+    }
+    with open(meta_file, 'w') as file:
+        json.dump(meta, file)
+    return partitions
+    # ---------------------------------------------------------- write_cache()
+
+
+def read_cache(cache_path, file_name):
+    """Reads the columnar binary cache of a city file if it is still valid.
+
+    The cache is valid if it has the current format version and the size
+    and modification time of the CSV file did not change. If only the
+    modification time changed, the content hash decides. If it matches, the
+    new modification time is stored, so the file is hashed only once. The
+    data of the cache is never changed by reading it.
+
+    The partition indexes are read once with the data and must cover all
+    of its rows, otherwise the cache is not valid either.
+
+    Args:
+        cache_path (string): the directory the cache was written to
+        file_name (string): the name of the CSV file the cache belongs to
+
+    Returns:
+        tuple: the cached data and a dict mapping the name of every index
+               of PARTITION_INDEXES to a dict holding the memory mapped
+               row positions (positions) and the start and stop offset of
+               every partition (offsets), or None if there is no valid
+               cache
+    """
+    meta_file = os.path.join(cache_path, 'meta.json')
+    try:
+        with open(meta_file) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_FORMAT_VERSION:
+        return None
+
+    fingerprint = get_file_fingerprint(file_name)
+    if fingerprint['size'] != meta['source']['size']:
+        return None
+    touched = fingerprint['mtime_ns'] != meta['source']['mtime_ns']
+    if touched and get_file_hash(file_name) != meta['source']['sha1']:
+        return None
+
+    partitions = {}
+    for name in PARTITION_INDEXES:
+        try:
+            offsets = meta['partitions'][name]
+            positions = np.load(
+                os.path.join(cache_path, 'index_' + name + '.npy'),
+                mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(positions) != meta['rows'] or any(
+                not 0 <= start <= stop <= meta['rows']
+                for start, stop in offsets.values()):
+            return None
+        partitions[name] = {'positions': positions, 'offsets': offsets}
+
+    columns = {}
+    for column_meta in meta['columns']:
+        values = np.load(
+            os.path.join(cache_path, column_meta['file']), mmap_mode='r')
+        if column_meta['kind'] == 'datetime':
+            columns[column_meta['name']] = values.view('datetime64[ns]')
+        elif column_meta['kind'] == 'category':
+            columns[column_meta['name']] = pd.Categorical.from_codes(
+                values, column_meta['categories'])
+        else:
+            columns[column_meta['name']] = values
+    df = pd.DataFrame(
+        columns, columns=[column['name'] for column in meta['columns']],
+        copy=False)
+
+    if touched:
+        # replaced at once, so a concurrent reader never sees a partial file
+        meta['source']['mtime_ns'] = fingerprint['mtime_ns']
+        with tempfile.NamedTemporaryFile(
+                'w', dir=cache_path, suffix='.tmp', delete=False) as file:
+            json.dump(meta, file)
+        os.replace(file.name, meta_file)
+    return df, partitions
+    # ----------------------------------------------------------- read_cache()
+
+
+def read_partition_rows(partitions, name, key):
+    """Returns the positions of the rows of one partition from the partition
+    indexes loaded with the cache. The positions are a slice of the memory
+    mapped index, so nothing is copied.
+
+    Args:
+        partitions (dict): the partition indexes as returned by read_cache()
+        name (string): the name of the partition index, see
+                       PARTITION_INDEXES
+        key (tuple): the values of the fields of the partition
+
+    Returns:
+        array: the ascending row positions
+    """
+    partition = partitions[name]
+    start, stop = partition['offsets'].get(
+        ','.join(str(value) for value in key), [0, 0])
+    return partition['positions'][start:stop]
+    # -------------------------------------------------- read_partition_rows()
+
+
+def get_filtered_view(data_frame, partitions, options):
+    """Fetches the rows matching the filter using the partition index of
+    the cache. The result looks exactly like the one of the boolean masks
+    in load_data(), including the columns added by reset_index().
+
+    Args:
+        data_frame (DataFrame): the unfiltered city data read from the cache
+        partitions (dict): the partition indexes as returned by read_cache()
+        options (dict): dictionary holding the filter
+
+    Returns:
+        DataFrame: the filtered data
+    """
+    month = options['month_of_interest']
+    day = options['day_of_interest']
+    if options['filter_type'] == 'Month':
+        rows = read_partition_rows(partitions, 'month', (month, ))
+    elif options['filter_type'] == 'Day':
+        rows = read_partition_rows(partitions, 'weekday', (day, ))
+    else:
+        rows = read_partition_rows(partitions, 'month_weekday', (month, day))
+
+    view = data_frame.take(rows).reset_index()
+    if options['filter_type'] == 'Both':
+        # the position within the month, which the second reset_index()
+        # of the masks would add
+        month_rows = read_partition_rows(partitions, 'month', (month, ))
+        view.insert(0, 'level_0', np.searchsorted(month_rows, rows))
+    return view
+    # ---------------------------------------------------- get_filtered_view()
+
+
+def load_indexed_city_data(file_name, cache_dir=None):
+    """Loads the unfiltered data of a city file and its partition indexes,
+    using the columnar binary cache if a cache directory is given.
+
+    Args:
+        file_name (string): the name of the CSV file to load
+        cache_dir (string): the directory holding the caches or None to
+                            always read the CSV file
+
+    Returns:
+        tuple: the unfiltered city data and the partition indexes as
+               returned by read_cache() or None without cache
+    """
+    if cache_dir is None:
+        return read_city_file(file_name), None
+
+    cache_path = get_cache_path(file_name, cache_dir)
+    with timed_span('read cache') as span:
+        cache = read_cache(cache_path, file_name)
+        span['rows'] = None if cache is None else len(cache[0])
+    if cache is not None:
+        return cache
+
+    df = read_city_file(file_name)
+    with timed_span('write cache') as span:
+        partitions = write_cache(df, cache_path, file_name)
+        span['rows'] = len(df)
+    return df, partitions
+    # ----------------------------------------------- load_indexed_city_data()
+
+
+def load_city_data(file_name, cache_dir=None):
+    """Loads the unfiltered data of a city file, using the columnar binary
+    cache if a cache directory is given.
+
+    Args:
+        file_name (string): the name of the CSV file to load
+        cache_dir (string): the directory holding the caches or None to
+                            always read the CSV file
+
+    Returns:
+        DataFrame: the unfiltered city data
+    """
+    return load_indexed_city_data(file_name, cache_dir)[0]
+    # ------------------------------------------------------- load_city_data()
+
+
+def create_session(memory_budget):
+    """Creates a session keeping the unfiltered data of recently used cities
+    loaded, so analyzing a city again does not read it again.
+
+    Args:
+        memory_budget (int): the bytes the loaded data may use. If it is
+                             exceeded, the least recently used cities are
+                             evicted.
+
+    Returns:
+        dict: the session holding the keys frames (the loaded data by file
+              name, the most recently used last), size, memory_budget, the
+              lock guarding them and file_locks (a lock by file name held
+              while the file is loaded)
+    """
+    return {
+        'frames': OrderedDict(),
+        'size': 0,
+        'memory_budget': memory_budget,
+        'lock': threading.Lock(),
+        'file_locks': {}
+    }
+    # ------------------------------------------------------- create_session()
+
+
+def get_session_city_data(session, file_name, fingerprint):
+    """Returns the data of a city file kept in a session and marks it as
+    recently used. The caller holds the lock of the session.
+
+    Args:
+        session (dict): the session as returned by create_session()
+        file_name (string): the name of the CSV file
+        fingerprint (tuple): the fingerprint of the file as returned by
+                             get_file_fingerprint()
+
+    Returns:
+        tuple: the unfiltered city data and its partition indexes like
+               load_indexed_city_data() returns them or None if the session
+               holds no data of the file as it is now
+    """
+    entry = session['frames'].get(file_name)
+    if entry is None or entry['fingerprint'] != fingerprint:
+        return None
+    session['frames'].move_to_end(file_name)
+    with timed_span('session') as span:
+        span['rows'] = len(entry['data_frame'])
+    return entry['data_frame'], entry['partitions']
+    # ------------------------------------------------ get_session_city_data()
+
+
+def load_session_city_data(session, file_name, cache_dir=None):
+    """Loads the unfiltered data of a city file and its partition indexes
+    like load_indexed_city_data() but returns the data kept in the session
+    if the file did not change. The
+    session may be shared by several threads. Each file is loaded by one
+    of them at a time while the others wait for it, files of other cities
+    are loaded at the same time.
+
+    Args:
+        session (dict): the session as returned by create_session()
+        file_name (string): the name of the CSV file to load
+        cache_dir (string): the directory holding the caches or None to
+                            always read the CSV file
+
+    Returns:
+        tuple: the unfiltered city data and its partition indexes or None
+               without cache
+    """
+    fingerprint = get_file_fingerprint(file_name)
+    with session['lock']:
+        city = get_session_city_data(session, file_name, fingerprint)
+        if city is not None:
+            return city
+        file_lock = session['file_locks'].setdefault(file_name,
+                                                     threading.Lock())
+
+    with file_lock:
+        # another thread may have loaded the file while this one waited
+        with session['lock']:
+            city = get_session_city_data(session, file_name, fingerprint)
+            if city is not None:
+                return city
+
+        df, partitions = load_indexed_city_data(file_name, cache_dir)
+
+        with session['lock']:
+            frames = session['frames']
+            if file_name in frames:
+                session['size'] -= frames.pop(file_name)['size']
+
+            # keep the data unless it alone exceeds the budget and evict the
+            # least recently used cities until it fits
+            size = int(df.memory_usage(index=True, deep=True).sum())
+            if size <= session['memory_budget']:
+                while frames and (session['size'] + size >
+                                  session['memory_budget']):
+                    session['size'] -= frames.popitem(last=False)[1]['size']
+                frames[file_name] = {
+                    'data_frame': df,
+                    'partitions': partitions,
+                    'fingerprint': fingerprint,
+                    'size': size
+                }
+                session['size'] += size
+        return df, partitions
+    # ----------------------------------------------- load_session_city_data()
+
+
 def load_data(options):
     """Loads data for the specified city and filters by month and day if
     applicable.
 
     Args:
-        options (dict): dictionary holding filters and user choices
+        options (dict): dictionary holding filters and user choices
+
+    Returns:
+        DataFrame containing city data filtered by month and day if applicable
+
+    `options` must contain
+        - city_of_interest: tuple containing [city_name][file_name]
+        - filter_type: String holding one of 'Month', 'Day', 'Both' or None
+        - month_of_interest: int holding the number of the month (1 = Jan)
+        - day_of_interest: int holding the weekday (0 = Mon)
+        - cache_dir: String holding the cache directory or None to disable
+                     the columnar binary cache
+        - session: dict as returned by create_session() to keep the data
+                   loaded between calls or None
+    """
+
+    if options['session'] is None:
+        df, partitions = load_indexed_city_data(
+            options['city_of_interest']['file'], options['cache_dir'])
+    else:
+        df, partitions = load_session_city_data(
+            options['session'], options['city_of_interest']['file'],
+            options['cache_dir'])
+    if options['filter_type'] is None:
+        return df
+
+    with timed_span('filter') as span:
+        if partitions is not None:
+            # use the partition index of the cache
+            view = get_filtered_view(df, partitions, options)
+        else:
+            # without cache apply the filters
+            view = df
+            if (options['filter_type'] == 'Month'
+                    or options['filter_type'] == 'Both'):
+                view = view[view['Month'] ==
+                            options['month_of_interest']].reset_index()
+            if (options['filter_type'] == 'Day'
+                    or options['filter_type'] == 'Both'):
+                view = view[view['Weekday'] ==
+                            options['day_of_interest']].reset_index()
+
+        span['rows'] = len(view)
+    return view
+    # ------------------------------------------------------------ load_data()
+
+
+def write_pickle(file_name, value):
+    """Pickles a value to a file. It is written to a temporary file in the
+    same directory first and renamed, so an interrupted or concurrent write
+    never leaves a partial file behind.
+
+    Args:
+        file_name (string): the name of the file to write
+        value (object): the value to pickle
+    """
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_name),
+                                     suffix='.tmp',
+                                     delete=False) as file:
+        try:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+    os.replace(file.name, file_name)
+    # --------------------------------------------------------- write_pickle()
+
+
+def get_results_path(cache_dir):
+    """Returns the directory the results of analyze() are stored in.
+
+    Args:
+        cache_dir (string): the directory holding all caches
+
+    Returns:
+        string: the path of the result cache, which cannot clash with the
+                cache of a city file
+    """
+    return os.path.join(cache_dir, '_results')
+    # ----------------------------------------------------- get_results_path()
+
+
+def get_results_key(options):
+    """Returns the key of the statistics analyze() prints for the given
+    options. It changes whenever the city file, the filter or the way the
+    statistics are calculated change.
+
+    Args:
+        options (dict): the options as described in analyze()
+
+    Returns:
+        string: the hex digest identifying the statistics
+    """
+    file_name = options['city_of_interest']['file']
+    key = {
+        'version': CACHE_FORMAT_VERSION,
+        'file': os.path.abspath(file_name),
+        'source': get_file_fingerprint(file_name),
+        'filter_type': options['filter_type'],
+        'stream': options['stream'],
+        'approximate': options['approximate'],
+        'incremental': options['incremental'],
+        'cube': options['cube'],
+    }
+    if options['filter_type'] in ('Month', 'Both'):
+        key['month'] = options['month_of_interest']
+    if options['filter_type'] in ('Day', 'Both'):
+        key['day'] = options['day_of_interest']
+    if options['approximate']:
+        key['sketch'] = [
+            options['sketch_size'], options['sketch_error'],
+            options['sketch_confidence']
+        ]
+    return hashlib.sha1(json.dumps(key,
+                                   sort_keys=True).encode()).hexdigest()
+    # ------------------------------------------------------ get_results_key()
+
+
+def read_results(cache_dir, key, max_age):
+    """Reads the statistics stored by write_results() if they are not too
+    old and marks them as recently used.
+
+    Args:
+        cache_dir (string): the directory holding all caches
+        key (string): the key returned by get_results_key()
+        max_age (float): the seconds the statistics are valid
+
+    Returns:
+        dict: the statistics or None if there are no valid ones
+    """
+    results_file = os.path.join(get_results_path(cache_dir), key + '.pkl')
+    try:
+        if time.time() - os.stat(results_file).st_mtime > max_age:
+            return None
+    except OSError:
+        return None
+    try:
+        with open(results_file, 'rb') as file:
+            statistics = pickle.load(file)
+    except Exception:
+        # a broken file or one stored by an incompatible version, unpickling
+        # it may raise about anything
+        try:
+            os.remove(results_file)
+        except OSError:
+            pass
+        return None
+
+    # the modification time records the last use for the eviction
+    os.utime(results_file)
+    return statistics
+    # --------------------------------------------------------- read_results()
+
+
+def write_results(cache_dir, key, statistics, max_size, max_age):
+    """Stores statistics for read_results() and evicts statistics older
+    than max_age and the least recently used until all fit into max_size.
+
+    The statistics are written by write_pickle(), so neither an interrupted
+    write nor a concurrent one leaves a partial file behind. Files evicted
+    by a concurrent call are skipped.
+
+    Args:
+        cache_dir (string): the directory holding all caches
+        key (string): the key returned by get_results_key()
+        statistics (dict): the statistics as returned by the calculate_*
+                           functions
+        max_size (int): the bytes all stored statistics may use
+        max_age (float): the seconds statistics are kept
+    """
+    results_path = get_results_path(cache_dir)
+    os.makedirs(results_path, exist_ok=True)
+    write_pickle(os.path.join(results_path, key + '.pkl'), statistics)
+
+    # the most recently used first
+    entries = []
+    for entry in os.scandir(results_path):
+        if entry.name.endswith('.pkl'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+
+    now = time.time()
+    total_size = 0
+    for mtime, size, path in entries:
+        total_size += size
+        if now - mtime > max_age or total_size > max_size:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    # -------------------------------------------------------- write_results()
+
+
+def count_by_partition(data_frame, field_list):
+    """Counts the rows of a DataFrame per partition and combination of
+    the given fields.
+
+    Args:
+        data_frame (DataFrame): the unfiltered city data
+        field_list (list): the fields to count the combinations of
+
+    Returns:
+        DataFrame: indexed by the partition fields and the given fields,
+                   holding the columns count and first, the label of the
+                   first row of each group
+    """
+    rows = pd.Series(data_frame.index, index=data_frame.index)
+    counts = rows.groupby(
+        [data_frame[field] for field in PARTITION_FIELDS + field_list],
+        observed=True).agg(['size', 'min'])
+    return counts.rename(columns={'size': 'count', 'min': 'first'})
+    # --------------------------------------------------- count_by_partition()
+
+
+def get_trips_by_partition(data_frame, index_function):
+    """Finds the shortest or longest trip of every partition.
+
+    Args:
+        data_frame (DataFrame): the unfiltered city data
+        index_function (string): idxmin for the shortest or idxmax for the
+                                 longest trips
+
+    Returns:
+        DataFrame: the trips indexed by the partition fields holding all
+                   columns of the city data, the label of the row (Row) and
+                   the position of the row within its month (Month Position)
+    """
+    trip_index = data_frame.groupby(PARTITION_FIELDS)['Trip Duration'].agg(
+        index_function)
+    month_position = data_frame.groupby('Month').cumcount()
+    trips = data_frame.loc[trip_index.values].copy()
+    trips['Row'] = trip_index.values
+    trips['Month Position'] = month_position.loc[trip_index.values].values
+    return trips.set_index(PARTITION_FIELDS, drop=False)
+    # ----------------------------------------------- get_trips_by_partition()
+
+
+def build_aggregates(data_frame, field_lists=AGGREGATED_FIELDS):
+    """Calculates everything needed by the statistics for all partitions of
+    the data in one grouped pass.
+
+    Args:
+        data_frame (DataFrame): the unfiltered city data
+        field_lists (tuple): the field combinations to count
+
+    Returns:
+        dict: a dictionary holding
+              - columns: the columns of the city data
+              - counts: a dict mapping every field combination of
+                field_lists found in the data to its counts
+              - durations: the sum and count of the trip durations
+              - shortest_trips and longest_trips: the trips per partition
+    """
+    return {
+        'columns': list(data_frame.columns),
+        'counts': {
+            field_list: count_by_partition(data_frame, list(field_list))
+            for field_list in field_lists
+            if all(field in data_frame for field in field_list)
+        },
+        'durations': data_frame.groupby(PARTITION_FIELDS)[
+            'Trip Duration'].agg(['sum', 'count']),
+        'shortest_trips': get_trips_by_partition(data_frame, 'idxmin'),
+        'longest_trips': get_trips_by_partition(data_frame, 'idxmax'),
+    }
+    # ----------------------------------------------------- build_aggregates()
+
+
+def merge_aggregates(first, second):
+    """Merges the aggregates of two consecutive parts of the same city data
+    as if they were built from both parts at once.
+
+    Args:
+        first (dict): the aggregates of the first part
+        second (dict): the aggregates of the rows following the first part
+
+    Returns:
+        dict: the merged aggregates
+    """
+
+    def merge_trips(key, longest):
+        # positions within the month continue after the rows of the same
+        # month in the first part
+        month_rows = first['counts'][()].groupby(
+            level='Month', observed=True)['count'].sum()
+        later_trips = second[key].copy()
+        later_trips['Month Position'] += later_trips['Month'].map(
+            month_rows).fillna(0).astype('int64').values
+        trips = pd.concat([first[key], later_trips]).sort_values(
+            ['Trip Duration', 'Row'], ascending=[not longest, True])
+        return trips.groupby(level=PARTITION_FIELDS).head(1).sort_index()
+
+    counts = {}
+    for field_list, first_counts in first['counts'].items():
+        merged = pd.concat([first_counts, second['counts'][field_list]])
+        counts[field_list] = merged.groupby(
+            level=list(range(merged.index.nlevels)), observed=True).agg({
+                'count': 'sum',
+                'first': 'min'
+            })
+    durations = pd.concat([first['durations'], second['durations']])
+
+    return {
+        'columns': first['columns'],
+        'counts': counts,
+        'durations': durations.groupby(level=PARTITION_FIELDS).sum(),
+        'shortest_trips': merge_trips('shortest_trips', False),
+        'longest_trips': merge_trips('longest_trips', True),
+    }
+    # ----------------------------------------------------- merge_aggregates()
+
+
+def concat_aggregates(parts):
+    """Combines the aggregates of disjoint partitions of the same city
+    data, e.g. of its months, as if they were built from all of them at
+    once. Unlike merge_aggregates() no group has to be added up, the
+    partitions only have to be put in order.
+
+    Args:
+        parts (list): the aggregates of every partition
+
+    Returns:
+        dict: the combined aggregates or None if there are no parts
+    """
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    return {
+        'columns': parts[0]['columns'],
+        'counts': {
+            field_list: pd.concat([part['counts'][field_list]
+                                   for part in parts]).sort_index()
+            for field_list in parts[0]['counts']
+        },
+        'durations': pd.concat([part['durations']
+                                for part in parts]).sort_index(),
+        'shortest_trips': pd.concat([part['shortest_trips']
+                                     for part in parts]).sort_index(),
+        'longest_trips': pd.concat([part['longest_trips']
+                                    for part in parts]).sort_index(),
+    }
+    # ---------------------------------------------------- concat_aggregates()
+
+
+def select_rows(data_frame, options):
+    """Selects the rows of the city data matching the filter.
+
+    Args:
+        data_frame (DataFrame): the city data
+        options (dict): dictionary holding filter_type, month_of_interest
+                        and day_of_interest
+
+    Returns:
+        DataFrame: the rows matching the filter
+    """
+    mask = np.ones(len(data_frame), dtype=bool)
+    if options['filter_type'] in ('Month', 'Both'):
+        mask &= (data_frame['Month'] == options['month_of_interest']).values
+    if options['filter_type'] in ('Day', 'Both'):
+        mask &= (data_frame['Weekday'] == options['day_of_interest']).values
+    return data_frame[mask]
+    # ---------------------------------------------------------- select_rows()
+
+
+def create_sketches(options):
+    """Creates the empty sketches used to approximate the station
+    statistics in bounded memory.
+
+    Every field combination of SKETCHED_FIELDS gets a Misra-Gries summary
+    keeping at most sketch_size counters. The station pairs are counted by
+    a count-min sketch as well. Its width and depth follow from the
+    allowed error sketch_error (relative to the number of rows) and the
+    probability sketch_confidence that this error holds.
+
+    Args:
+        options (dict): dictionary holding at least sketch_size,
+                        sketch_error and sketch_confidence
+
+    Returns:
+        dict: a dictionary holding
+              - rows: the number of rows added so far
+              - size: the maximum number of counters of every summary
+              - heavy_hitters: a dict mapping every field combination of
+                SKETCHED_FIELDS to its counters and their error
+              - count_min: the count-min table of the station pairs
+    """
+    width = int(np.ceil(np.e / options['sketch_error']))
+    depth = int(np.ceil(np.log(1 / (1 - options['sketch_confidence']))))
+    return {
+        'rows': 0,
+        'size': options['sketch_size'],
+        'heavy_hitters': {
+            field_list: {
+                'counts': pd.Series(dtype='int64'),
+                'error': 0
+            }
+            for field_list in SKETCHED_FIELDS
+        },
+        'count_min': np.zeros((depth, width), dtype='int64'),
+    }
+    # ------------------------------------------------------ create_sketches()
+
+
+def merge_heavy_hitters(summary, counts, size):
+    """Merges exact counts into a Misra-Gries summary. If more than size
+    counters are left, the count of the counter following the size largest
+    is subtracted from all counters and those not above zero are dropped.
+
+    Every counter is at most the true count and at least the true count
+    minus the error of the summary, the sum of everything subtracted.
+
+    Args:
+        summary (dict): the summary holding counts and error, updated in
+                        place
+        counts (Series): the exact counts to add, indexed by value
+        size (int): the maximum number of counters to keep
+    """
+    merged = summary['counts'].add(counts, fill_value=0).astype('int64')
+    if len(merged) > size:
+        threshold = merged.nlargest(size + 1).iloc[-1]
+        merged = merged[merged > threshold] - threshold
+        summary['error'] += int(threshold)
+    summary['counts'] = merged
+    # -------------------------------------------------- merge_heavy_hitters()
+
+
+def get_count_min_hashes(data_frame, depth):
+    """Hashes the rows of a DataFrame once for every row of a count-min
+    table, using a different hash key each time.
+
+    Args:
+        data_frame (DataFrame): the values to hash
+        depth (int): the number of rows of the count-min table
+
+    Returns:
+        list: an array of unsigned 64 bit hashes per row of the table
+    """
+    return [
+        pd.util.hash_pandas_object(data_frame,
+                                   index=False,
+                                   hash_key='{:016d}'.format(row)).values
+        for row in range(depth)
+    ]
+    # ------------------------------------------------- get_count_min_hashes()
+
+
+def update_sketches(sketches, data_frame):
+    """Adds the rows of a DataFrame to the sketches.
+
+    Args:
+        sketches (dict): the sketches as returned by create_sketches(),
+                         updated in place
+        data_frame (DataFrame): the rows to add
+    """
+    sketches['rows'] += len(data_frame)
+    for field_list, summary in sketches['heavy_hitters'].items():
+        counts = get_group_sizes(data_frame, list(field_list))
+        # plain labels, so counts of chunks with different categories align
+        counts.index = counts.index.to_flat_index().astype(object)
+        merge_heavy_hitters(summary, counts, sketches['size'])
+
+    pairs = data_frame[['Start Station', 'End Station']].dropna()
+    table = sketches['count_min']
+    for row, hashes in enumerate(get_count_min_hashes(pairs, len(table))):
+        table[row] += np.bincount(hashes % table.shape[1],
+                                  minlength=table.shape[1])
+    # ------------------------------------------------------ update_sketches()
+
+
+def estimate_pair_count(sketches, start_station, end_station):
+    """Estimates how often a trip was taken using the count-min sketch.
+    The estimate is never below the true count.
+
+    Args:
+        sketches (dict): the sketches as returned by create_sketches()
+        start_station (string): the start station of the trip
+        end_station (string): the end station of the trip
+
+    Returns:
+        int: the estimated count of the trip
+    """
+    table = sketches['count_min']
+    pair = pd.DataFrame({
+        'Start Station': [start_station],
+        'End Station': [end_station]
+    })
+    return int(
+        min(table[row, hashes[0] % table.shape[1]] for row, hashes in
+            enumerate(get_count_min_hashes(pair, len(table)))))
+    # -------------------------------------------------- estimate_pair_count()
+
+
+def stream_aggregates(options, sketches=None):
+    """Builds the aggregates of the city of interest by reading its CSV file
+    in chunks, so only one chunk has to fit in memory at a time.
+
+    If sketches are given, the fields of SKETCHED_FIELDS are not counted
+    exactly. Instead the rows matching the filter are added to the
+    sketches.
+
+    Args:
+        options (dict): dictionary holding at least city_of_interest and
+                        chunk_size
+        sketches (dict): the sketches as returned by create_sketches() or
+                         None to count all fields exactly
+
+    Returns:
+        dict: the aggregates as returned by build_aggregates() or None if
+              the file holds no rows
+    """
+    field_lists = AGGREGATED_FIELDS
+    if sketches is not None:
+        field_lists = tuple(field_list for field_list in AGGREGATED_FIELDS
+                            if field_list not in SKETCHED_FIELDS)
+
+    aggregates = None
+    for chunk in read_city_file_chunks(options['city_of_interest']['file'],
+                                       options['chunk_size']):
+        chunk_aggregates = build_aggregates(chunk, field_lists)
+        if sketches is not None:
+            update_sketches(sketches, select_rows(chunk, options))
+        if aggregates is None:
+            aggregates = chunk_aggregates
+        else:
+            aggregates = merge_aggregates(aggregates, chunk_aggregates)
+    return aggregates
+    # ---------------------------------------------------- stream_aggregates()
+
+
+def get_ingest_check(file, offset):
+    """Calculates the SHA-1 hash of the INGEST_CHECK_SIZE bytes of a file
+    before an offset.
+
+    Args:
+        file (file): the file opened in binary mode
+        offset (int): the offset the checked bytes end at
+
+    Returns:
+        string: the hex digest of the bytes
+    """
+    start = max(0, offset - INGEST_CHECK_SIZE)
+    file.seek(start)
+    return hashlib.sha1(file.read(offset - start)).hexdigest()
+    # ----------------------------------------------------- get_ingest_check()
+
+
+def count_complete_rows(file, offset):
+    """Counts the rows of a file after an offset which end with a line
+    break. The file is read in blocks, so it never has to fit in memory.
+
+    Args:
+        file (file): the file opened in binary mode
+        offset (int): the offset the rows start at
+
+    Returns:
+        tuple: the number of complete rows and the offset after the last of
+               them
+    """
+    file.seek(offset)
+    rows, end = 0, offset
+    for block in iter(lambda: file.read(1 << 20), b''):
+        rows += block.count(b'\n')
+        if b'\n' in block:
+            end = offset + block.rfind(b'\n') + 1
+        offset += len(block)
+    return rows, end
+    # -------------------------------------------------- count_complete_rows()
+
+
+def read_stored_aggregates(cache_path):
+    """Reads the aggregates stored in the cache by write_stored_aggregates().
+
+    Args:
+        cache_path (string): the directory of the cache of the city file
+
+    Returns:
+        dict: the state of ingest_aggregates() holding the aggregates or
+              None if there are no stored aggregates of the current format
+    """
+    try:
+        with open(os.path.join(cache_path, 'aggregates.pkl'), 'rb') as file:
+            state = pickle.load(file)
+    except Exception:
+        # a missing or broken file, unpickling may raise about anything
+        return None
+    if state.get('version') != CACHE_FORMAT_VERSION:
+        return None
+    return state
+    # ----------------------------------------------- read_stored_aggregates()
+
+
+def write_stored_aggregates(cache_path, state):
+    """Stores the aggregates of a city file in its cache. They are written
+    by write_pickle(), so an interrupted or concurrent write never leaves a
+    partial file behind.
+
+    Args:
+        cache_path (string): the directory of the cache of the city file
+        state (dict): the state of ingest_aggregates() holding the
+                      aggregates
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    write_pickle(os.path.join(cache_path, 'aggregates.pkl'), state)
+    # ---------------------------------------------- write_stored_aggregates()
+
+
+def read_ingest_state(cache_path, file):
+    """Reads the state stored by ingest_aggregates() if the city file still
+    starts with the rows it was built from.
+
+    Args:
+        cache_path (string): the directory of the cache of the city file
+        file (file): the city file opened in binary mode
+
+    Returns:
+        dict: the state or None if there is no valid state
+    """
+    state = read_stored_aggregates(cache_path)
+    if state is None:
+        return None
+    if os.fstat(file.fileno()).st_size < state['offset']:
+        return None
+    if get_ingest_check(file, state['offset']) != state['check']:
+        return None
+    return state
+    # ---------------------------------------------------- read_ingest_state()
+
+
+def ingest_aggregates(options):
+    """Returns the aggregates of the city of interest, parsing only the rows
+    appended since the last call.
+
+    The aggregates are stored in the cache with the byte offset of the end
+    of the last row ingested. The rows after it are streamed from the file
+    in chunks and merged into the stored aggregates, so the cost only
+    depends on the new rows and only one chunk has to fit in memory. A last
+    row without line break is still being written and is left for the next
+    call. If the file was rewritten, it is ingested again from the start.
+
+    Once every row is ingested, the fingerprint of the file is stored with
+    the aggregates, so load_cube() can use them without reading the file.
+
+    Args:
+        options (dict): dictionary holding at least city_of_interest,
+                        cache_dir and chunk_size
+
+    Returns:
+        dict: the aggregates as returned by build_aggregates() or None if
+              no complete row was written yet
+    """
+    file_name = options['city_of_interest']['file']
+    cache_path = get_cache_path(file_name, options['cache_dir'])
+
+    with open(file_name, 'rb') as file:
+        # taken before reading, so rows appended meanwhile change it
+        stat = os.fstat(file.fileno())
+        state = read_ingest_state(cache_path, file)
+        if state is None:
+            file.seek(0)
+            header = file.readline()
+            state = {
+                'version': CACHE_FORMAT_VERSION,
+                'header': header,
+                'offset': len(header),
+                'rows': 0,
+                'aggregates': None,
+                'source': None
+            }
+        with timed_span('scan appended') as span:
+            rows, end = count_complete_rows(file, state['offset'])
+            span['rows'] = rows
+        source = None
+        if end == stat.st_size:
+            source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if not rows:
+            # the file may have been touched or had its last row completed
+            if state['source'] != source and state['aggregates'] is not None:
+                state['source'] = source
+                write_stored_aggregates(cache_path, state)
+            return state['aggregates']
+
+        # the rows keep their labels, as if the file was read at once
+        aggregates = state['aggregates']
+        file.seek(state['offset'])
+        chunks = pd.read_csv(
+            file,
+            header=None,
+            names=pd.read_csv(io.BytesIO(state['header']), nrows=0).columns,
+            parse_dates=[1, 2],
+            nrows=rows,
+            chunksize=options['chunk_size'])
+        for chunk in chunks:
+            chunk.index = pd.RangeIndex(state['rows'],
+                                        state['rows'] + len(chunk))
+            state['rows'] += len(chunk)
+            chunk_aggregates = build_aggregates(prepare_city_data(chunk))
+            if aggregates is None:
+                aggregates = chunk_aggregates
+            else:
+                aggregates = merge_aggregates(aggregates, chunk_aggregates)
+
+        state['aggregates'] = aggregates
+        state['source'] = source
+        state['offset'] = end
+        state['check'] = get_ingest_check(file, end)
+    write_stored_aggregates(cache_path, state)
+    return aggregates
+    # ---------------------------------------------------- ingest_aggregates()
+
+
+def load_aggregates(options):
+    """Loads the unfiltered data of the city of interest and builds its
+    aggregates.
+
+    Args:
+        options (dict): dictionary holding at least city_of_interest and
+                        cache_dir
+
+    Returns:
+        dict: the aggregates as returned by build_aggregates()
+    """
+    return build_aggregates(
+        load_city_data(options['city_of_interest']['file'],
+                       options['cache_dir']))
+    # ------------------------------------------------------ load_aggregates()
+
+
+def load_cube(options):
+    """Loads the aggregate cube of the city of interest. The cube are the
+    aggregates of build_aggregates() partitioned by month and weekday, so
+    every filter is answered by rolling up the partitions it selects
+    without touching the trips.
+
+    The cube are the aggregates stored by ingest_aggregates(). They are
+    used as they are while the size and modification time of the city file
+    match the ones stored with them, otherwise the file is ingested first.
+
+    Args:
+        options (dict): dictionary holding at least city_of_interest,
+                        cache_dir and chunk_size
+
+    Returns:
+        dict: the aggregates as returned by build_aggregates() or None if
+              the file holds no rows
+    """
+    file_name = options['city_of_interest']['file']
+    state = read_stored_aggregates(
+        get_cache_path(file_name, options['cache_dir']))
+    if (state is not None and state['source'] is not None
+            and state['source'] == get_file_fingerprint(file_name)):
+        return state['aggregates']
+
+    with timed_span('build cube'):
+        return ingest_aggregates(options)
+    # ------------------------------------------------------------ load_cube()
+
+
+def get_city_months(file_name, cache_dir):
+    """Loads a city file, which writes its cache, and returns the months it
+    holds. This function is run by the worker processes of
+    load_parallel_aggregates().
+
+    Args:
+        file_name (string): the name of the CSV file to load
+        cache_dir (string): the directory holding the caches
+
+    Returns:
+        list: the numbers of the months in ascending order
+    """
+    df = load_city_data(file_name, cache_dir)
+    return [int(month) for month in np.unique(df['Month'])]
+    # ------------------------------------------------------ get_city_months()
+
+
+def build_month_aggregates(file_name, cache_dir, month):
+    """Builds the aggregates of one month of a city file. This function is
+    run by the worker processes of load_parallel_aggregates().
+
+    Args:
+        file_name (string): the name of the CSV file to load
+        cache_dir (string): the directory holding the caches or None
+        month (int): the month to aggregate or None for the whole file
+
+    Returns:
+        dict: the aggregates as returned by build_aggregates()
+    """
+    df, partitions = load_indexed_city_data(file_name, cache_dir)
+    if month is not None:
+        if partitions is None:
+            df = df[df['Month'] == month]
+        else:
+            df = df.take(read_partition_rows(partitions, 'month', (month, )))
+    return build_aggregates(df)
+    # ----------------------------------------------- build_month_aggregates()
+
+
+def run_timed_task(function_name, *args):
+    """Runs a task of load_parallel_aggregates() in a worker process and
+    notes when it started and ended. The times are taken from the clock of
+    the system, so the times of all processes can be compared.
+
+    Args:
+        function_name (function): the function to call
+        *args: Variable length argument list which is passed to the called
+               function
+
+    Returns:
+        tuple: the result and the start and end time of the task
+    """
+    start = timer()
+    result = function_name(*args)
+    return result, start, timer()
+    # ------------------------------------------------------- run_timed_task()
+
+
+def load_parallel_aggregates(city_dicts, options):
+    """Builds the aggregates of several cities in a pool of processes.
+
+    If the cache is enabled, every city is loaded and its cache is written
+    by a task of its own first. As soon as a city is loaded, every month of
+    it is aggregated by its own task, which only memory maps the cache.
+    Otherwise every city is one task. The aggregates of the months are
+    combined by concat_aggregates(), so the result does not depend on the
+    number of jobs.
+
+    The load time of a city runs from the start of its first task to the
+    end of its last one.
+
+    Args:
+        city_dicts (list): the cities to aggregate as found in city_data
+        options (dict): dictionary holding at least cache_dir and jobs
+
+    Returns:
+        list: a tuple of the aggregates and the load time of every city in
+              the order of city_dicts
+    """
+    cache_dir = options['cache_dir']
+    with ProcessPoolExecutor(max_workers=options['jobs']) as pool:
+        times = {city_dict['file']: [] for city_dict in city_dicts}
+        if cache_dir is None:
+            tasks = {
+                city_dict['file']: [
+                    pool.submit(run_timed_task, build_month_aggregates,
+                                city_dict['file'], None, None)
+                ]
+                for city_dict in city_dicts
+            }
+        else:
+            months = {
+                city_dict['file']:
+                pool.submit(run_timed_task, get_city_months,
+                            city_dict['file'], cache_dir)
+                for city_dict in city_dicts
+            }
+            tasks = {}
+            for file_name, future in months.items():
+                city_months, *task_times = future.result()
+                times[file_name].extend(task_times)
+                tasks[file_name] = [
+                    pool.submit(run_timed_task, build_month_aggregates,
+                                file_name, cache_dir, month)
+                    for month in city_months
+                ]
+
+        all_aggregates = {}
+        for file_name, futures in tasks.items():
+            parts = []
+            for future in futures:
+                month_aggregates, *task_times = future.result()
+                times[file_name].extend(task_times)
+                parts.append(month_aggregates)
+            all_aggregates[file_name] = (
+                concat_aggregates(parts),
+                max(times[file_name]) - min(times[file_name]))
+
+    return [all_aggregates[city_dict['file']] for city_dict in city_dicts]
+    # --------------------------------------------- load_parallel_aggregates()
+
+
+def get_partition_mask(data_frame, options):
+    """Marks the rows of an aggregate belonging to the partitions matching
+    the filter.
+
+    Args:
+        data_frame (DataFrame): an aggregate indexed by the partition fields
+        options (dict): dictionary holding filter_type, month_of_interest
+                        and day_of_interest
+
+    Returns:
+        array: True for every row of a matching partition
+    """
+    mask = np.ones(len(data_frame), dtype=bool)
+    if options['filter_type'] in ('Month', 'Both'):
+        mask &= (data_frame.index.get_level_values('Month') ==
+                 options['month_of_interest'])
+    if options['filter_type'] in ('Day', 'Both'):
+        mask &= (data_frame.index.get_level_values('Weekday') ==
+                 options['day_of_interest'])
+    return mask
+    # --------------------------------------------------- get_partition_mask()
+
+
+def select_partitions(data_frame, options):
+    """Selects the partitions of an aggregate matching the filter.
+
+    Args:
+        data_frame (DataFrame): an aggregate indexed by the partition fields
+        options (dict): dictionary holding filter_type, month_of_interest
+                        and day_of_interest
+
+    Returns:
+        DataFrame: the rows of the partitions matching the filter
+    """
+    return data_frame[get_partition_mask(data_frame, options)]
+    # ---------------------------------------------------- select_partitions()
+
+
+def get_partition_rollups(aggregates, field_list, partition_fields,
+                          filter_fields):
+    """Rolls up the counts of a field combination to the given partition
+    fields, e.g. to the months by summing up their weekdays, and splits
+    them by the partition fields a filter selects.
+
+    The roll ups are calculated on first use and kept with the aggregates,
+    so every filter only has to look up its partition.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        field_list (tuple): the field combination to roll up
+        partition_fields (tuple): the partition fields to keep, in the
+                                  order of PARTITION_FIELDS
+        filter_fields (tuple): the partition fields selected by the filter,
+                               in the order of PARTITION_FIELDS
+
+    Returns:
+        dict: the roll ups by the tuple of the values of filter_fields,
+              holding the columns count and first and indexed by the
+              remaining partition fields and the fields of field_list
+    """
+    rollups = aggregates.setdefault('rollups', {})
+    key = (field_list, partition_fields, filter_fields)
+    if key not in rollups:
+        counts = aggregates['counts'][field_list]
+        if list(partition_fields) != PARTITION_FIELDS:
+            counts = counts.groupby(
+                level=list(partition_fields + field_list),
+                observed=True).agg({
+                    'count': 'sum',
+                    'first': 'min'
+                })
+        if not filter_fields:
+            rollups[key] = {(): counts}
+        else:
+            rollups[key] = {
+                values if isinstance(values, tuple) else (values, ):
+                group.droplevel(list(filter_fields))
+                for values, group in counts.groupby(
+                    level=list(filter_fields), observed=True)
+            }
+        # the roll up of a partition without trips
+        rollups[key][None] = counts.iloc[:0].droplevel(list(filter_fields))
+    return rollups[key]
+    # ------------------------------------------------ get_partition_rollups()
+
+
+def rollup_counts(aggregates,
+                  options,
+                  field_list,
+                  group_list=None,
+                  plan=None):
+    """Rolls up the counts of the partitions matching the filter.
+
+    The counts are taken from the roll up of the partition the filter
+    selects, see get_partition_rollups(). Grouping again is only needed if
+    group_list does not hold all of its fields.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        field_list (tuple): the field combination to roll up
+        group_list (list): the fields to group by, defaults to field_list
+        plan (dict): the plan to share the roll up with other statistics
+
+    Returns:
+        DataFrame: the columns count and first, indexed by group_list
+    """
+    group_list = list(group_list or field_list)
+
+    def rollup():
+        filter_values = {}
+        if options['filter_type'] in ('Month', 'Both'):
+            filter_values['Month'] = options['month_of_interest']
+        if options['filter_type'] in ('Day', 'Both'):
+            filter_values['Weekday'] = options['day_of_interest']
+        partition_fields = tuple(
+            field for field in PARTITION_FIELDS
+            if field in filter_values or field in group_list)
+        rollups = get_partition_rollups(aggregates, field_list,
+                                        partition_fields,
+                                        tuple(filter_values))
+        counts = rollups.get(tuple(filter_values.values()), rollups[None])
+        if list(counts.index.names) == group_list:
+            return counts
+        return counts.groupby(level=group_list, observed=True).agg({
+            'count': 'sum',
+            'first': 'min'
+        })
+
+    return get_planned(plan, ('rollup', field_list, tuple(group_list)),
+                       rollup)
+    # -------------------------------------------------------- rollup_counts()
+
+
+def get_aggregated_most_common_value(aggregates, options, field,
+                                     plan=None):
+    """Calculates the most common value (mode) of a field from the
+    aggregates. Like Series.mode() the smallest value wins a tie.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        field (string): the field to calculate the modal from
+        plan (dict): the plan to share the roll up with
+
+    Returns:
+        the most common value of the field
+    """
+    if field in PARTITION_FIELDS:
+        counts = rollup_counts(aggregates, options, (), [field], plan)
+    else:
+        counts = rollup_counts(aggregates, options, (field, ), plan=plan)
+    return counts['count'].idxmax()
+    # ------------------------------------- get_aggregated_most_common_value()
+
+
+def get_aggregated_group_by_count(aggregates,
+                                  options,
+                                  field_list,
+                                  largest,
+                                  plan=None):
+    """Finds the largest or smallest group of a field combination from the
+    aggregates. Like nlargest() and nsmallest() the first group in sort
+    order wins a tie.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        field_list (tuple): the field combination to group by
+        largest (bool): True for the largest, False for the smallest group
+        plan (dict): the plan to share the roll up with
+
+    Returns:
+        dict: the values of the fields of the group and its count
+    """
+    counts = rollup_counts(aggregates, options, field_list,
+                           plan=plan)['count']
+    group = counts.idxmax() if largest else counts.idxmin()
+    if len(field_list) == 1:
+        group = (group, )
+    result = dict(zip(field_list, group))
+    result['count'] = counts[group if len(field_list) > 1 else group[0]]
+    return result
+    # ---------------------------------------- get_aggregated_group_by_count()
+
+
+def get_aggregated_total(aggregates, options):
+    """Calculates the total trip duration from the aggregates.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+
+    Returns:
+        the sum of the trip durations
+    """
+    return select_partitions(aggregates['durations'], options)['sum'].sum()
+    # ------------------------------------------------- get_aggregated_total()
+
+
+def get_aggregated_average(aggregates, options):
+    """Calculates the average trip duration from the aggregates.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+
+    Returns:
+        the mean of the trip durations
+    """
+    durations = select_partitions(aggregates['durations'], options).sum()
+    return durations['sum'] / durations['count']
+    # ----------------------------------------------- get_aggregated_average()
+
+
+def get_aggregated_trip(aggregates, options, longest):
+    """Finds the shortest or longest trip from the aggregates. Like idxmin()
+    and idxmax() the first row wins a tie.
+
+    The returned row looks like the one load_data() returns for the same
+    filter, including the index columns added by reset_index().
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        longest (bool): True for the longest, False for the shortest trip
+
+    Returns:
+        Series: all columns of the trip
+    """
+    # only the durations and rows of the matching partitions are sorted
+    trips = aggregates['longest_trips' if longest else 'shortest_trips']
+    positions = np.flatnonzero(get_partition_mask(trips, options))
+    durations = trips['Trip Duration'].values[positions]
+    order = np.lexsort((trips['Row'].values[positions],
+                        -durations if longest else durations))
+    trip = trips.iloc[positions[order[0]]]
+    # the columns of the city data come first, see get_trips_by_partition()
+    details = trip.iloc[:len(aggregates['columns'])]
+    if options['filter_type'] is None:
+        return details
+    index = {'index': trip['Row']}
+    if options['filter_type'] == 'Both':
+        index = {'level_0': trip['Month Position'], 'index': trip['Row']}
+    return pd.Series(np.concatenate(
+        [np.array(list(index.values()), dtype=object), details.values]),
+                     index=list(index) + list(details.index),
+                     dtype=object)
+    # -------------------------------------------------- get_aggregated_trip()
+
+
+def get_aggregated_value_counts(aggregates,
+                                options,
+                                field,
+                                normalize=False,
+                                plan=None):
+    """Calculates the value counts of a field from the aggregates. Equal
+    counts are ordered by first appearance like value_counts() does.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        field (string): the field to calculate the values of
+        normalize (bool): True to return the ratio in percent
+        plan (dict): the plan to share the roll up with
 
     Returns:
-        DataFrame containing city data filtered by month and day if applicable
+        Series: the count of distinct values
+    """
+    counts = rollup_counts(aggregates, options, (field, ), plan=plan)
+    counts = counts['count'].iloc[np.lexsort(
+        (counts['first'].values, -counts['count'].values))]
+    if normalize:
+        return counts / counts.sum() * 100
+    return counts
+    # ------------------------------------------ get_aggregated_value_counts()
+
+
+def get_aggregated_max_of_group(aggregates,
+                                options,
+                                field_list,
+                                group_value,
+                                plan=None):
+    """Finds the most common value of the second field within the group of
+    the first field from the aggregates.
 
-    `options` must contain
-        - city_of_interest: tuple containing [city_name][file_name]
-        - filter_type: String holding one of 'Month', 'Day', 'Both' or None
-        - month_of_interest: int holding the number of the month (1 = Jan)
-        - day_of_interest: int holding the weekday (0 = Mon)
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (dict): dictionary holding the filter
+        field_list (tuple): the group field and the field to search in
+        group_value (Object): the value the group should be filtered by
+        plan (dict): the plan to share the roll up with
+
+    Returns:
+        dict: the value found and its count
     """
+    counts = rollup_counts(aggregates, options, field_list,
+                           plan=plan)['count'].xs(group_value,
+                                                  level=field_list[0])
+    value = counts.idxmax()
+    return {field_list[1]: value, 'count': counts[value]}
+    # ------------------------------------------ get_aggregated_max_of_group()
 
-    # load data file into a dataframe
-    # as we know the format in advance we will convert columns 1 and 2 to
-    # datetime and afterwards drop the first column to remove the unnamed
-    # column that exists in the csv files
-    df = pd.read_csv(options['city_of_interest']['file'], parse_dates=[1, 2])
-    df = df.drop(df.columns[0], axis=1)
-
-    # create new columns having month, weekday, and start hour
-    df['Month'] = df['Start Time'].dt.month
-    df['Weekday'] = df['Start Time'].dt.weekday
-    df['Start Hour'] = df['Start Time'].dt.hour
-    df['End Hour'] = df['End Time'].dt.hour
-
-    # apply the filters if applicable
-    if options['filter_type'] is not None:
-        if (options['filter_type'] == 'Month'
-                or options['filter_type'] == 'Both'):
-            df = df[df['Month'] == options['month_of_interest']].reset_index()
-        if (options['filter_type'] == 'Day'
-                or options['filter_type'] == 'Both'):
-            df = df[df['Weekday'] == options['day_of_interest']].reset_index()
-
-    return df
-    # ------------------------------------------------------------ load_data()
 
+def get_aggregated_min(aggregates, options, field, plan=None):
+    """Calculates the minimum value of a field from the aggregates."""
+    return rollup_counts(aggregates, options, (field, ),
+                         plan=plan).index.min()
+    # --------------------------------------------------- get_aggregated_min()
 
-def analyze(options):
-    """Calculates statistics base on the given options.
 
-    Args:
-        options (Dict): a dictionary holding at least the keys
-        - city_of_interest (Tuple): Holds the name of the City and the
-                                    name of the CSV file to analyze.
-        - filter_type (String): One of None, Month, Day or Both
-                                Specifies the filter wanted.
-        - month_of_interest (int): The number of the Month to analyze where
-                                   January = 1
-        - day_of_interest (int): The weekday to analyze where Monday = 0
-        - interactive (bool): If true this function asks the user to restart
-                              the process
-    """
+def get_aggregated_max(aggregates, options, field, plan=None):
+    """Calculates the maximum value of a field from the aggregates."""
+    return rollup_counts(aggregates, options, (field, ),
+                         plan=plan).index.max()
+    # --------------------------------------------------- get_aggregated_max()
 
-    print('\nStart analyzing your data ...')
 
-    # first load the data into a data frame
-    city_df, total_time = timed_calculation(load_data, options)
-    print('\n({:3.4f}s) Loaded file {}.'.format(
-        total_time, options['city_of_interest']['file']))
+def calculate_statistics(city_df, options):
+    """Calculates all statistics for a loaded and filtered DataFrame.
+
+    Args:
+        city_df (DataFrame): the data returned by load_data()
+        options (Dict): the options used to load the data, only
+                        filter_type is used here
+
+    Returns:
+        dict: a dictionary mapping the name of each statistic to a tuple
+              holding the result and the time the calculation took
+    """
+    statistics = {}
+    # groupings and value counts shared by several statistics
+    plan = {}
 
     # -------------------------------
     # #1 Popular times of travel
@@ -297,177 +2284,550 @@ def analyze(options):
     # Do we need to display the month? If we filter by day or do not
     # filter at all, we calculate it.
     if (options['filter_type'] is None or options['filter_type'] == 'Day'):
-        most_common_month, total_time = timed_calculation(
-            get_most_common_value, city_df, 'Month')
-        print(
-            '({:3.4f}s) The most popular month for traveling is "{}".'.format(
-                total_time, calendar.month_name[most_common_month]))
+        statistics['most_common_month'] = timed_calculation(
+            get_most_common_value, city_df, 'Month', plan)
 
     # Same logic applies to the day. If we filter by day anyway we need
     # not to display that data.
     if (options['filter_type'] is None or options['filter_type'] == 'Month'):
-        most_common_weekday, total_time = timed_calculation(
-            get_most_common_value, city_df, 'Weekday')
-        print('({:3.4f}s) The most popular weekday for traveling is "{}".'.
-              format(total_time, calendar.day_name[most_common_weekday]))
+        statistics['most_common_weekday'] = timed_calculation(
+            get_most_common_value, city_df, 'Weekday', plan)
 
     # The most popular hour is calculated every time.
-    most_common_hour, total_time = timed_calculation(get_most_common_value,
-                                                     city_df, 'Start Hour')
-    print('({:3.4f}s) The most popular hour for traveling is "{}".'.format(
-        total_time, most_common_hour))
+    statistics['most_common_start_hour'] = timed_calculation(
+        get_most_common_value, city_df, 'Start Hour', plan)
 
     # The most popular return hour
-    most_common_hour, total_time = timed_calculation(get_most_common_value,
-                                                     city_df, 'End Hour')
-    print('({:3.4f}s) The most popular return hour is "{}".'.format(
-        total_time, most_common_hour))
+    statistics['most_common_end_hour'] = timed_calculation(
+        get_most_common_value, city_df, 'End Hour', plan)
 
     # ------------------------------------------------
     # 2 Popular and unpopular stations and trips
     #
     # most common start station
-    most_common_start_station, total_time = timed_calculation(
-        get_most_common_value, city_df, 'Start Station')
-    print('({:3.4f}s) The most popular start station is "{}".'.format(
-        total_time, most_common_start_station))
+    statistics['most_common_start_station'] = timed_calculation(
+        get_most_common_value, city_df, 'Start Station', plan)
 
     # most common end station
-    most_common_end_station, total_time = timed_calculation(
-        get_most_common_value, city_df, 'End Station')
-    print('({:3.4f}s) The most popular end station is "{}".'.format(
-        total_time, most_common_end_station))
+    statistics['most_common_end_station'] = timed_calculation(
+        get_most_common_value, city_df, 'End Station', plan)
 
     # most common trip from start to end (i.e., most frequent combination
     # of start station and end station)
     most_common_trip, total_time = timed_calculation(
-        get_nlargest_by_group, city_df, ['Start Station', 'End Station'], 1)
-    print(
-        '({:3.4f}s) The most popular trip from start to end is from "{}" '
-        ' to "{}", which was taken {} times.'.format(
-            total_time, most_common_trip['Start Station'][0],
-            most_common_trip['End Station'][0], most_common_trip['count'][0]))
+        get_nlargest_by_group, city_df, ['Start Station', 'End Station'], 1,
+        plan)
+    statistics['most_common_trip'] = (most_common_trip.iloc[0], total_time)
 
-    # Print one of the most unpopular trips - there is a high probability that
-    # there are more than one trips that are taken only 1 times. But print
-    # that anyway.
+    # There is a high probability that there are more than one trips that
+    # are taken only 1 times. But keep one of them anyway.
     most_unpopular_trip, total_time = timed_calculation(
-        get_nsmallest_by_group, city_df, ['Start Station', 'End Station'], 1)
-    print(
-        '({:3.4f}s) One of the most unpopular trips from start to end is from '
-        '"{}" to "{}", which was only taken {} times.'.format(
-            total_time, most_unpopular_trip['Start Station'][0],
-            most_unpopular_trip['End Station'][0],
-            most_unpopular_trip['count'][0]))
+        get_nsmallest_by_group, city_df, ['Start Station', 'End Station'], 1,
+        plan)
+    statistics['most_unpopular_trip'] = (most_unpopular_trip.iloc[0],
+                                         total_time)
 
     # ---------------------------------------------------
     # 3 Trip duration
     # total travel time
-    total_trip_duration, total_time = timed_calculation(
+    statistics['total_trip_duration'] = timed_calculation(
         get_total, city_df, 'Trip Duration')
-    print('({:3.4f}s) The total travel time is {}.'.format(
-        total_time, str(pd.to_timedelta(total_trip_duration, unit='s'))))
 
     # average travel time
-    average_trip_duration, total_time = timed_calculation(
+    statistics['average_trip_duration'] = timed_calculation(
         get_average, city_df, 'Trip Duration')
-    print('({:3.4f}s) The average travel time is {}.'.format(
-        total_time, str(pd.to_timedelta(average_trip_duration, unit='s'))))
 
     # shortest trip
     shortest_trip_index, total_time1 = timed_calculation(
         get_min_index, city_df, 'Trip Duration')
     shortest_trip, total_time2 = timed_calculation(get_row_by_index, city_df,
                                                    shortest_trip_index)
-    print('({:3.4f}s) The shortest trip is {}. Trip details are:'.format(
-        total_time1 + total_time2,
-        str(pd.to_timedelta(shortest_trip['Trip Duration'], unit='s'))))
-    print(shortest_trip.to_string())
+    statistics['shortest_trip'] = (shortest_trip, total_time1 + total_time2)
 
     # longest trip
     longest_trip_index, total_time1 = timed_calculation(
         get_max_index, city_df, 'Trip Duration')
     longest_trip, total_time2 = timed_calculation(get_row_by_index, city_df,
                                                   longest_trip_index)
-    print('({:3.4f}s) The longest trip is {}. Trip details are:'.format(
-        total_time1 + total_time2,
-        str(pd.to_timedelta(longest_trip['Trip Duration'], unit='s'))))
-    print(longest_trip.to_string())
+    statistics['longest_trip'] = (longest_trip, total_time1 + total_time2)
 
     # -------------------------------
     # 4 User info
     # counts of each user type
-    users_breakdown, total_time = timed_calculation(get_value_counts, city_df,
-                                                    'User Type')
-    print('({:3.4f}s) The different users are:'.format(total_time))
-    for i, v in users_breakdown.items():
-        print('{}\t{}'.format(i, v))
+    statistics['user_types'] = timed_calculation(get_value_counts, city_df,
+                                                 'User Type', plan)
 
     # raio of user type
-    users_ratio, total_time = timed_calculation(get_ratio, city_df,
-                                                'User Type')
-    print('({:3.4f}s) This is a ratio of:'.format(total_time))
-    for i, v in users_ratio.items():
-        print('{}\t{:3.2f} %'.format(i, v))
+    statistics['user_types_ratio'] = timed_calculation(
+        get_ratio, city_df, 'User Type', plan)
 
     if 'Gender' in city_df:
         # counts of each gender (only available for NYC and Chicago)
-        gender_breakdown, total_time = timed_calculation(
-            get_value_counts, city_df, 'Gender')
-        print('({:3.4f}s) Differences of gender is:'.format(total_time))
-        for i, v in gender_breakdown.items():
-            print('{}\t{}'.format(i, v))
+        statistics['genders'] = timed_calculation(get_value_counts, city_df,
+                                                  'Gender', plan)
 
         # ratio of gender
-        gender_ratio, total_time = timed_calculation(get_ratio, city_df,
-                                                     'Gender')
-        print('({:3.4f}s) The gender ratio is:'.format(total_time))
-        for i, v in gender_ratio.items():
-            print('{}\t{:3.2f} %'.format(i, v))
+        statistics['genders_ratio'] = timed_calculation(
+            get_ratio, city_df, 'Gender', plan)
 
         # when do men and women most often start
-        max_of_group, total_time = timed_calculation(
+        statistics['male_start_station'] = timed_calculation(
             get_max_of_group, city_df, ['Gender', 'Start Station'], 'Gender',
-            'Male')
-        print('({:3.4f}s) Men most often start from "{}" ({} Times).'.format(
-            total_time, max_of_group['Start Station'], max_of_group['count']))
-        max_of_group, total_time = timed_calculation(
+            'Male', plan)
+        statistics['female_start_station'] = timed_calculation(
             get_max_of_group, city_df, ['Gender', 'Start Station'], 'Gender',
-            'Female')
-        print('({:3.4f}s) Women most often start from "{}" ({} Times).'.format(
-            total_time, max_of_group['Start Station'], max_of_group['count']))
+            'Female', plan)
 
         # what timeframe per gender
-        max_of_group, total_time = timed_calculation(get_max_of_group, city_df,
-                                                     ['Gender', 'Start Hour'],
-                                                     'Gender', 'Male')
-        print('({:3.4f}s) Men most often start at "{}" o\'clock ({} Times).'.
-              format(total_time, max_of_group['Start Hour'],
-                     max_of_group['count']))
-        max_of_group, total_time = timed_calculation(get_max_of_group, city_df,
-                                                     ['Gender', 'Start Hour'],
-                                                     'Gender', 'Female')
-        print('({:3.4f}s) Women most often start at "{}" o\'clock ({} Times).'.
-              format(total_time, max_of_group['Start Hour'],
-                     max_of_group['count']))
+        statistics['male_start_hour'] = timed_calculation(
+            get_max_of_group, city_df, ['Gender', 'Start Hour'], 'Gender',
+            'Male', plan)
+        statistics['female_start_hour'] = timed_calculation(
+            get_max_of_group, city_df, ['Gender', 'Start Hour'], 'Gender',
+            'Female', plan)
 
     # earliest, most recent, most common year of birth (only available for
     # NYC and Chicago)
     if 'Birth Year' in city_df:
-        # earliest
-        youngest, total_time = timed_calculation(get_max, city_df,
+        statistics['youngest'] = timed_calculation(get_max, city_df,
+                                                   'Birth Year')
+        statistics['oldest'] = timed_calculation(get_min, city_df,
                                                  'Birth Year')
-        print('({:3.4f}s) The yougest driver was born in {:4.0f}.'.format(
-            total_time, youngest))
-        # most recent
-        oldest, total_time = timed_calculation(get_min, city_df, 'Birth Year')
-        print('({:3.4f}s) The oldest was born in {:4.0f}.'.format(
-            total_time, oldest))
-        # most common
-        most_common, total_time = timed_calculation(get_most_common_value,
-                                                    city_df, 'Birth Year')
-        print('({:3.4f}s) The most common year of birth is {:4.0f}.'.format(
-            total_time, most_common))
+        statistics['most_common_birth_year'] = timed_calculation(
+            get_most_common_value, city_df, 'Birth Year', plan)
+
+    return statistics
+    # ------------------------------------------------- calculate_statistics()
+
+
+def calculate_aggregated_statistics(aggregates, options):
+    """Calculates the same statistics as calculate_statistics() by rolling
+    up the aggregates of the partitions matching the filter.
+
+    Args:
+        aggregates (dict): the aggregates as returned by build_aggregates()
+        options (Dict): the filter to use
+
+    Returns:
+        dict: a dictionary mapping the name of each statistic to a tuple
+              holding the result and the time the calculation took
+    """
+    statistics = {}
+    # roll ups shared by several statistics
+    plan = {}
+
+    # 1 Popular times of travel
+    if (options['filter_type'] is None or options['filter_type'] == 'Day'):
+        statistics['most_common_month'] = timed_calculation(
+            get_aggregated_most_common_value, aggregates, options,
+            'Month', plan)
+    if (options['filter_type'] is None or options['filter_type'] == 'Month'):
+        statistics['most_common_weekday'] = timed_calculation(
+            get_aggregated_most_common_value, aggregates, options,
+            'Weekday', plan)
+    statistics['most_common_start_hour'] = timed_calculation(
+        get_aggregated_most_common_value, aggregates, options,
+        'Start Hour', plan)
+    statistics['most_common_end_hour'] = timed_calculation(
+        get_aggregated_most_common_value, aggregates, options,
+        'End Hour', plan)
+
+    # 2 Popular and unpopular stations and trips, unless they were sketched
+    if ('Start Station', 'End Station') in aggregates['counts']:
+        statistics['most_common_start_station'] = timed_calculation(
+            get_aggregated_most_common_value, aggregates, options,
+            'Start Station', plan)
+        statistics['most_common_end_station'] = timed_calculation(
+            get_aggregated_most_common_value, aggregates, options,
+            'End Station', plan)
+        statistics['most_common_trip'] = timed_calculation(
+            get_aggregated_group_by_count, aggregates, options,
+            ('Start Station', 'End Station'), True, plan)
+        statistics['most_unpopular_trip'] = timed_calculation(
+            get_aggregated_group_by_count, aggregates, options,
+            ('Start Station', 'End Station'), False, plan)
+
+    # 3 Trip duration
+    statistics['total_trip_duration'] = timed_calculation(
+        get_aggregated_total, aggregates, options)
+    statistics['average_trip_duration'] = timed_calculation(
+        get_aggregated_average, aggregates, options)
+    statistics['shortest_trip'] = timed_calculation(
+        get_aggregated_trip, aggregates, options, False)
+    statistics['longest_trip'] = timed_calculation(
+        get_aggregated_trip, aggregates, options, True)
+
+    # 4 User info
+    statistics['user_types'] = timed_calculation(
+        get_aggregated_value_counts, aggregates, options,
+        'User Type', False, plan)
+    statistics['user_types_ratio'] = timed_calculation(
+        get_aggregated_value_counts, aggregates, options,
+        'User Type', True, plan)
+
+    if ('Gender', ) in aggregates['counts']:
+        statistics['genders'] = timed_calculation(
+            get_aggregated_value_counts, aggregates, options,
+            'Gender', False, plan)
+        statistics['genders_ratio'] = timed_calculation(
+            get_aggregated_value_counts, aggregates, options,
+            'Gender', True, plan)
+        for gender in ('Male', 'Female'):
+            statistics[gender.lower() + '_start_station'] = timed_calculation(
+                get_aggregated_max_of_group, aggregates, options,
+                ('Gender', 'Start Station'), gender, plan)
+            statistics[gender.lower() + '_start_hour'] = timed_calculation(
+                get_aggregated_max_of_group, aggregates, options,
+                ('Gender', 'Start Hour'), gender, plan)
+
+    if ('Birth Year', ) in aggregates['counts']:
+        statistics['youngest'] = timed_calculation(
+            get_aggregated_max, aggregates, options, 'Birth Year', plan)
+        statistics['oldest'] = timed_calculation(
+            get_aggregated_min, aggregates, options, 'Birth Year', plan)
+        statistics['most_common_birth_year'] = timed_calculation(
+            get_aggregated_most_common_value, aggregates, options,
+            'Birth Year', plan)
+
+    return statistics
+    # -------------------------------------- calculate_aggregated_statistics()
+
+
+def get_sketched_most_common_value(sketches, field_list):
+    """Finds the most common value of a field combination in its Misra-Gries
+    summary.
+
+    Args:
+        sketches (dict): the sketches as returned by create_sketches()
+        field_list (tuple): the sketched field combination
+
+    Returns:
+        tuple: the most common value, the lowest and the highest possible
+               count of it
+    """
+    summary = sketches['heavy_hitters'][field_list]
+    value = summary['counts'].idxmax()
+    count = int(summary['counts'][value])
+    return value, count, count + summary['error']
+    # --------------------------------------- get_sketched_most_common_value()
+
+
+def get_sketched_trip(sketches):
+    """Finds the most common trip in the sketches. The highest possible
+    count is limited by both the summary and the count-min sketch.
+
+    Args:
+        sketches (dict): the sketches as returned by create_sketches()
+
+    Returns:
+        tuple: the trip as a dict like get_group_by_count() returns it and the
+               lowest and the highest possible count of it
+    """
+    (start_station, end_station), count, max_count = (
+        get_sketched_most_common_value(sketches,
+                                       ('Start Station', 'End Station')))
+    max_count = min(
+        max_count, estimate_pair_count(sketches, start_station, end_station))
+    trip = {
+        'Start Station': start_station,
+        'End Station': end_station,
+        'count': count
+    }
+    return trip, count, max_count
+    # ---------------------------------------------------- get_sketched_trip()
+
+
+def calculate_sketched_statistics(sketches):
+    """Calculates the station statistics approximated by the sketches and
+    the bounds of their counts.
+
+    Args:
+        sketches (dict): the sketches as returned by create_sketches()
+
+    Returns:
+        dict: a dictionary mapping the name of each statistic to a tuple
+              holding the result and the time the calculation took. The
+              bounds are stored as sketch_bounds, a dict mapping a
+              description of each result to its lowest and highest
+              possible count.
+    """
+    statistics = {}
+    bounds = {}
+    bounds_time = 0
+
+    for field, name in (('Start Station', 'start station'),
+                        ('End Station', 'end station')):
+        (value, min_count, max_count), total_time = timed_calculation(
+            get_sketched_most_common_value, sketches, (field, ))
+        statistics['most_common_' + name.replace(' ', '_')] = (value,
+                                                               total_time)
+        bounds['{} "{}"'.format(name, value)] = (min_count, max_count)
+        bounds_time += total_time
+
+    (trip, min_count, max_count), total_time = timed_calculation(
+        get_sketched_trip, sketches)
+    statistics['most_common_trip'] = (trip, total_time)
+    bounds['trip from "{}" to "{}"'.format(
+        trip['Start Station'], trip['End Station'])] = (min_count, max_count)
+    bounds_time += total_time
+
+    statistics['sketch_bounds'] = (bounds, bounds_time)
+    return statistics
+    # ---------------------------------------- calculate_sketched_statistics()
+
+
+def format_time(total_time):
+    """Formats the time a statistic took to calculate as printed in front of
+    it.
+
+    Args:
+        total_time (float): the seconds or None if the statistic was read
+                            from the result cache
+
+    Returns:
+        string: the time in parentheses
+    """
+    if total_time is None:
+        return '(cached)'
+    return '({:3.4f}s)'.format(total_time)
+    # ---------------------------------------------------------- format_time()
+
+
+def print_statistics(statistics):
+    """Prints the statistics calculated by one of the calculate_*
+    functions.
+
+    Args:
+        statistics (dict): a dictionary mapping the name of each statistic
+                           to a tuple holding the result and the time the
+                           calculation took or None if it was read from the
+                           result cache. Missing statistics are skipped.
+    """
+
+    if 'most_common_month' in statistics:
+        most_common_month, total_time = statistics['most_common_month']
+        print('{} The most popular month for traveling is "{}".'.format(
+            format_time(total_time), calendar.month_name[most_common_month]))
+
+    if 'most_common_weekday' in statistics:
+        most_common_weekday, total_time = statistics['most_common_weekday']
+        print('{} The most popular weekday for traveling is "{}".'.format(
+            format_time(total_time),
+            calendar.day_name[most_common_weekday]))
+
+    most_common_hour, total_time = statistics['most_common_start_hour']
+    print('{} The most popular hour for traveling is "{}".'.format(
+        format_time(total_time), most_common_hour))
+
+    most_common_hour, total_time = statistics['most_common_end_hour']
+    print('{} The most popular return hour is "{}".'.format(
+        format_time(total_time), most_common_hour))
+
+    most_common_start_station, total_time = statistics[
+        'most_common_start_station']
+    print('{} The most popular start station is "{}".'.format(
+        format_time(total_time), most_common_start_station))
+
+    most_common_end_station, total_time = statistics[
+        'most_common_end_station']
+    print('{} The most popular end station is "{}".'.format(
+        format_time(total_time), most_common_end_station))
+
+    most_common_trip, total_time = statistics['most_common_trip']
+    print(
+        '{} The most popular trip from start to end is from "{}" '
+        ' to "{}", which was taken {} times.'.format(
+            format_time(total_time), most_common_trip['Start Station'],
+            most_common_trip['End Station'], most_common_trip['count']))
+
+    if 'sketch_bounds' in statistics:
+        sketch_bounds, total_time = statistics['sketch_bounds']
+        print('{} The stations and trips above are approximated, '
+              'their true counts are:'.format(format_time(total_time)))
+        for i, (min_count, max_count) in sketch_bounds.items():
+            print('{}\t{} to {}'.format(i, min_count, max_count))
+
+    if 'most_unpopular_trip' in statistics:
+        most_unpopular_trip, total_time = statistics['most_unpopular_trip']
+        print(
+            '{} One of the most unpopular trips from start to end is '
+            'from "{}" to "{}", which was only taken {} times.'.format(
+                format_time(total_time), most_unpopular_trip['Start Station'],
+                most_unpopular_trip['End Station'],
+                most_unpopular_trip['count']))
+
+    total_trip_duration, total_time = statistics['total_trip_duration']
+    print('{} The total travel time is {}.'.format(
+        format_time(total_time),
+        str(pd.to_timedelta(total_trip_duration, unit='s'))))
+
+    average_trip_duration, total_time = statistics['average_trip_duration']
+    print('{} The average travel time is {}.'.format(
+        format_time(total_time),
+        str(pd.to_timedelta(average_trip_duration, unit='s'))))
+
+    shortest_trip, total_time = statistics['shortest_trip']
+    print('{} The shortest trip is {}. Trip details are:'.format(
+        format_time(total_time),
+        str(pd.to_timedelta(shortest_trip['Trip Duration'], unit='s'))))
+    print(shortest_trip.to_string())
+
+    longest_trip, total_time = statistics['longest_trip']
+    print('{} The longest trip is {}. Trip details are:'.format(
+        format_time(total_time),
+        str(pd.to_timedelta(longest_trip['Trip Duration'], unit='s'))))
+    print(longest_trip.to_string())
+
+    users_breakdown, total_time = statistics['user_types']
+    print('{} The different users are:'.format(format_time(total_time)))
+    for i, v in users_breakdown.items():
+        print('{}\t{}'.format(i, v))
+
+    users_ratio, total_time = statistics['user_types_ratio']
+    print('{} This is a ratio of:'.format(format_time(total_time)))
+    for i, v in users_ratio.items():
+        print('{}\t{:3.2f} %'.format(i, v))
+
+    if 'genders' in statistics:
+        gender_breakdown, total_time = statistics['genders']
+        print('{} Differences of gender is:'.format(format_time(total_time)))
+        for i, v in gender_breakdown.items():
+            print('{}\t{}'.format(i, v))
+
+        gender_ratio, total_time = statistics['genders_ratio']
+        print('{} The gender ratio is:'.format(format_time(total_time)))
+        for i, v in gender_ratio.items():
+            print('{}\t{:3.2f} %'.format(i, v))
+
+        max_of_group, total_time = statistics['male_start_station']
+        print('{} Men most often start from "{}" ({} Times).'.format(
+            format_time(total_time), max_of_group['Start Station'],
+            max_of_group['count']))
+        max_of_group, total_time = statistics['female_start_station']
+        print('{} Women most often start from "{}" ({} Times).'.format(
+            format_time(total_time), max_of_group['Start Station'],
+            max_of_group['count']))
+
+        max_of_group, total_time = statistics['male_start_hour']
+        print('{} Men most often start at "{}" o\'clock ({} Times).'.
+              format(format_time(total_time), max_of_group['Start Hour'],
+                     max_of_group['count']))
+        max_of_group, total_time = statistics['female_start_hour']
+        print('{} Women most often start at "{}" o\'clock ({} Times).'.
+              format(format_time(total_time), max_of_group['Start Hour'],
+                     max_of_group['count']))
+
+    if 'youngest' in statistics:
+        youngest, total_time = statistics['youngest']
+        print('{} The yougest driver was born in {:4.0f}.'.format(
+            format_time(total_time), youngest))
+        oldest, total_time = statistics['oldest']
+        print('{} The oldest was born in {:4.0f}.'.format(
+            format_time(total_time), oldest))
+        most_common, total_time = statistics['most_common_birth_year']
+        print('{} The most common year of birth is {:4.0f}.'.format(
+            format_time(total_time), most_common))
+    # ----------------------------------------------------- print_statistics()
+
+
+def analyze(options):
+    """Calculates statistics base on the given options.
+
+    Args:
+        options (Dict): a dictionary holding at least the keys
+        - city_of_interest (Tuple): Holds the name of the City and the
+                                    name of the CSV file to analyze.
+        - filter_type (String): One of None, Month, Day or Both
+                                Specifies the filter wanted.
+        - month_of_interest (int): The number of the Month to analyze where
+                                   January = 1
+        - day_of_interest (int): The weekday to analyze where Monday = 0
+        - interactive (bool): If true this function asks the user to restart
+                              the process
+        - stream (bool): If true the CSV file is read in chunks of
+                         chunk_size rows which are aggregated one by one
+        - approximate (bool): If true and streamed, the station statistics
+                              are approximated by sketches in bounded
+                              memory, see create_sketches()
+        - incremental (bool): If true only the rows appended since the
+                              last run are parsed and merged into the
+                              aggregates stored in the cache, see
+                              ingest_aggregates()
+        - cube (bool): If true the statistics are rolled up from the
+                       aggregate cube stored in the cache, see load_cube()
+        - result_cache (bool): If true and cache_dir is not None, the
+                               statistics are stored there and read again
+                               instead of loading the file as long as the
+                               file and the options do not change
+        - result_cache_size (int): the bytes the stored statistics may use
+        - result_cache_age (float): the seconds statistics are stored
+    """
+
+    print('\nStart analyzing your data ...')
+
+    statistics = None
+    results_key = None
+    if options['result_cache'] and options['cache_dir'] is not None:
+        results_key = get_results_key(options)
+        statistics, total_time = timed_calculation(
+            read_results, options['cache_dir'], results_key,
+            options['result_cache_age'])
+
+    if statistics is not None:
+        print('\n({:3.4f}s) Read the statistics of file {} from the cache.'.
+              format(total_time, options['city_of_interest']['file']))
+        # the times were measured by the run which stored the statistics
+        statistics = {
+            name: (value, None)
+            for name, (value, _) in statistics.items()
+        }
+        results_key = None
+    elif options['incremental']:
+        aggregates, total_time = timed_calculation(ingest_aggregates, options)
+        print('\n({:3.4f}s) Ingested the new rows of file {}.'.format(
+            total_time, options['city_of_interest']['file']))
+
+        if aggregates is not None:
+            statistics = calculate_aggregated_statistics(aggregates, options)
+    elif options['cube']:
+        aggregates, total_time = timed_calculation(load_cube, options)
+        print('\n({:3.4f}s) Loaded the cube of file {}.'.format(
+            total_time, options['city_of_interest']['file']))
+
+        if aggregates is not None:
+            statistics = calculate_aggregated_statistics(aggregates, options)
+    elif options['stream']:
+        # aggregate the file chunk by chunk instead of loading it at once
+        sketches = None
+        if options['approximate']:
+            sketches = create_sketches(options)
+        aggregates, total_time = timed_calculation(stream_aggregates, options,
+                                                   sketches)
+        print('\n({:3.4f}s) Streamed file {}.'.format(
+            total_time, options['city_of_interest']['file']))
+
+        if aggregates is not None:
+            statistics = calculate_aggregated_statistics(aggregates, options)
+            if sketches is not None:
+                statistics.update(calculate_sketched_statistics(sketches))
+    else:
+        # first load the data into a data frame
+        city_df, total_time = timed_calculation(load_data, options)
+        print('\n({:3.4f}s) Loaded file {}.'.format(
+            total_time, options['city_of_interest']['file']))
+
+        statistics = calculate_statistics(city_df, options)
+
+    if statistics is None:
+        # an empty file or one without a complete row yet
+        print('\nThere are no trips in file {}.'.format(
+            options['city_of_interest']['file']))
+    else:
+        print_statistics(statistics)
+        if results_key is not None:
+            write_results(options['cache_dir'], results_key, statistics,
+                          options['result_cache_size'],
+                          options['result_cache_age'])
 
     if options['interactive']:
         # start over or quit
@@ -475,7 +2835,241 @@ def analyze(options):
             input('\nTo restart, press enter. To quit, press "Ctrl-C".')
         except KeyboardInterrupt:
             raise
-    # ---------------------------------------------------------------analyze()
+    # -------------------------------------------------------------- analyze()
+
+
+def analyze_aggregates(aggregates, options, load_time):
+    """Prints the statistics for the given options like analyze() does but
+    uses aggregates which were loaded before.
+
+    Args:
+        aggregates (dict): the aggregates of the city of interest as
+                           returned by build_aggregates()
+        options (Dict): the options as described in analyze()
+        load_time (float): the time loading the aggregates took
+    """
+
+    print('\nStart analyzing your data ...')
+    print('\n({:3.4f}s) Loaded file {}.'.format(
+        load_time, options['city_of_interest']['file']))
+
+    print_statistics(calculate_aggregated_statistics(aggregates, options))
+    # --------------------------------------------------- analyze_aggregates()
+
+
+def analyze_parallel(options):
+    """Analyzes the city of interest or all cities using a pool of
+    processes and prints the results in the order of city_data.
+
+    Args:
+        options (Dict): the options as described in analyze() plus
+        - city_data (Tuple): the cities to choose from
+        - all_cities (bool): If true all cities in city_data are analyzed
+        - jobs (int): The number of processes to use
+    """
+    if options['all_cities']:
+        city_dicts = list(options['city_data'])
+    else:
+        city_dicts = [options['city_of_interest']]
+
+    # recorded as span, the load time of every city is its own
+    all_aggregates, _ = timed_calculation(load_parallel_aggregates,
+                                          city_dicts, options)
+    for city_dict, (aggregates, load_time) in zip(city_dicts,
+                                                  all_aggregates):
+        print('-' * 80)
+        print('Analyzing data for city "{}" ..'.format(city_dict['name']))
+        options['city_of_interest'] = city_dict
+        analyze_aggregates(aggregates, options, load_time)
+    # ----------------------------------------------------- analyze_parallel()
+
+
+def get_json_value(value):
+    """Converts the result of a statistic into plain Python types which can
+    be written as JSON. Rows and value counts become objects, missing
+    values null.
+
+    Args:
+        value: a result of one of the calculate_* functions
+
+    Returns:
+        the value as dict, list, string, number, bool or None
+    """
+    if isinstance(value, pd.Series):
+        value = value.to_dict()
+    if isinstance(value, dict):
+        return {str(key): get_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [get_json_value(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (pd.Timestamp, pd.Timedelta)):
+        return str(value)
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+    # ------------------------------------------------------- get_json_value()
+
+
+def get_request_options(query, options):
+    """Returns the options of a statistics request sent to serve().
+
+    Args:
+        query (dict): the parameters of the request as returned by
+                      parse_qs(): city (name), filter (one of
+                      allowed_filters), month (name or number) and weekday
+                      (name or number, 0 = Monday)
+        options (dict): the options of the server
+
+    Returns:
+        dict: a copy of the options using the parameters given
+
+    Raises:
+        ValueError: if a parameter is unknown or has an invalid value
+    """
+
+    def get_number(name, names, allowed):
+        """Returns the number of a month or weekday given by name or
+        number."""
+        value = query[name][-1]
+        number = names.index(value) if value in names else None
+        if number is None and value.isdigit():
+            number = int(value)
+        if number not in allowed:
+            raise ValueError('Invalid {} "{}".'.format(name, value))
+        return number
+
+    unknown = set(query) - {'city', 'filter', 'month', 'weekday'}
+    if unknown:
+        raise ValueError('Unknown parameters {}.'.format(sorted(unknown)))
+
+    request_options = dict(options, interactive=False)
+    if 'city' in query:
+        for city_dict in options['city_data']:
+            if city_dict['name'] == query['city'][-1]:
+                request_options['city_of_interest'] = city_dict
+                break
+        else:
+            raise ValueError('Unknown city "{}".'.format(query['city'][-1]))
+    if 'filter' in query:
+        if query['filter'][-1] not in options['allowed_filters']:
+            raise ValueError('Invalid filter "{}".'.format(
+                query['filter'][-1]))
+        request_options['filter_type'] = (None if query['filter'][-1] ==
+                                          'None' else query['filter'][-1])
+    if 'month' in query:
+        request_options['month_of_interest'] = get_number(
+            'month', list(calendar.month_name), options['allowed_months'])
+    if 'weekday' in query:
+        request_options['day_of_interest'] = get_number(
+            'weekday', list(calendar.day_name), options['allowed_days'])
+    return request_options
+    # -------------------------------------------------- get_request_options()
+
+
+def serve(options):
+    """Serves the statistics analyze() prints as JSON on a local HTTP
+    endpoint until Ctrl+C is pressed. The loaded cities are kept in a
+    session shared by a pool of worker threads, so only the first request
+    of a city pays for loading it.
+
+    The endpoints are
+        - GET /cities: the names of all cities
+        - GET /statistics?city=Chicago&filter=Both&month=March&weekday=0:
+          the statistics as object mapping their names to value and
+          seconds, all parameters are optional and default to the options
+
+    Args:
+        options (Dict): the options as described in analyze() plus
+        - host (String): the address to listen on
+        - port (int): the port to listen on
+        - workers (int): the number of requests answered at once
+    """
+    options['session'] = create_session(options['session_memory_budget'])
+
+    def get_statistics(request_options):
+        """Calculates the statistics of a request as JSON object."""
+        city_df = load_data(request_options)
+        statistics = calculate_statistics(city_df, request_options)
+        return {
+            'city': request_options['city_of_interest']['name'],
+            'filter': request_options['filter_type'],
+            'month': request_options['month_of_interest'],
+            'weekday': request_options['day_of_interest'],
+            'statistics': {
+                name: {
+                    'value': get_json_value(value),
+                    'seconds': total_time
+                }
+                for name, (value, total_time) in statistics.items()
+            }
+        }
+
+    class StatisticsHandler(BaseHTTPRequestHandler):
+        """Answers the requests of one connection."""
+
+        def do_GET(self):
+            """Answers a GET request with a JSON document."""
+            url = urlparse(self.path)
+            if url.path == '/cities':
+                self.send_json(200, [
+                    city_dict['name'] for city_dict in options['city_data']
+                ])
+            elif url.path == '/statistics':
+                try:
+                    request_options = get_request_options(
+                        parse_qs(url.query, keep_blank_values=True), options)
+                except ValueError as error:
+                    self.send_json(400, {'error': str(error)})
+                    return
+                try:
+                    statistics = get_statistics(request_options)
+                except Exception as error:
+                    self.log_error('Calculating the statistics failed: %r',
+                                   error)
+                    self.send_json(500, {'error': str(error)})
+                    return
+                self.send_json(200, statistics)
+            else:
+                self.send_json(404, {'error': 'Unknown path.'})
+
+        def send_json(self, status, document):
+            """Sends a JSON document as response."""
+            body = json.dumps(document).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer((options['host'], options['port']), StatisticsHandler)
+    with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+
+        def process_request(request, client_address):
+            """Hands a connection over to the pool of workers."""
+
+            def answer():
+                try:
+                    server.finish_request(request, client_address)
+                except Exception:
+                    server.handle_error(request, client_address)
+                finally:
+                    server.shutdown_request(request)
+
+            pool.submit(answer)
+
+        server.process_request = process_request
+        print('Serving statistics on http://{}:{}/ ...'.format(
+            *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('\nGoodby ...')
+        finally:
+            server.server_close()
+    # ---------------------------------------------------------------- serve()
 
 
 def show_menu():
@@ -546,6 +3140,7 @@ def show_menu():
         print('Please choose a city or press return to discard\nthe change:')
 
         # show a list of valid cities
+        city_data = options['city_data']
         for city_dict in city_data:
             print('({}) {}'.format(
                 city_data.index(city_dict) + 1, city_dict['name']))
@@ -716,6 +3311,10 @@ def show_menu():
 
         # --------------------------------------------------- get_user_input()
 
+    # keep the loaded cities in memory, so changing the filter or analyzing
+    # a city again does not load it again
+    options['session'] = create_session(options['session_memory_budget'])
+
     # show a menu until Ctrl+C or Ctrl+D is pressed
     while True:
         try:
@@ -731,21 +3330,30 @@ def show_menu():
     # ------------------------------------------------------------ show_menu()
 
 
-def test():
-    """Function to run different calls to analyze."""
+def test(options):
+    """Function to run different calls to analyze.
+
+    Every city is loaded only once and aggregated by month and weekday in a
+    single grouped pass, using options['jobs'] processes. Each filter
+    combination then only rolls up the partitions it selects.
+    """
     options['interactive'] = False
-    for city_dict in city_data:
+    city_data = options['city_data']
+    all_aggregates, _ = timed_calculation(load_parallel_aggregates,
+                                          city_data, options)
+    for city_dict, (aggregates, load_time) in zip(city_data, all_aggregates):
         print('-' * 80)
         print('Analyzing data for city "{}" ..'.format(city_dict['name']))
         options['city_of_interest'] = city_data[city_data.index(city_dict)]
-        analyze(options)
+        options['filter_type'] = None
+        analyze_aggregates(aggregates, options, load_time)
         for month in options['allowed_months']:
             print('-' * 80)
             print('Analyzing again using Filter "Month" for "{}" ..'.format(
                 calendar.month_name[month]))
             options['filter_type'] = 'Month'
             options['month_of_interest'] = month
-            analyze(options)
+            analyze_aggregates(aggregates, options, load_time)
             for day in options['allowed_days']:
                 print('-' * 80)
                 print(
@@ -753,14 +3361,14 @@ def test():
                     format(calendar.month_name[month], calendar.day_name[day]))
                 options['filter_type'] = 'Both'
                 options['day_of_interest'] = day
-                analyze(options)
+                analyze_aggregates(aggregates, options, load_time)
         for day in options['allowed_days']:
             print('-' * 80)
             print('Analyzing again using Filter "Day" for "{}" ..'.format(
                 calendar.day_name[day]))
             options['filter_type'] = 'Day'
             options['day_of_interest'] = day
-            analyze(options)
+            analyze_aggregates(aggregates, options, load_time)
     # ----------------------------------------------------------------- test()
 
 
@@ -769,6 +3377,8 @@ def parse_arguments():
     will be executed next.
     """
 
+    city_data = options['city_data']
+
     def find_city_dict(city_name):
         """Helper function to find the dict containing the given city_name in
         city_data."""
@@ -776,6 +3386,30 @@ def parse_arguments():
             if city_dict['name'] == city_name:
                 return city_data.index(city_dict)
 
+    def get_positive_int(value):
+        """Helper function to convert an argument to a number of at least
+        one."""
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise ap.ArgumentTypeError(
+                '{} is not a positive number'.format(value))
+        return number
+
+    def get_fraction(value):
+        """Helper function to convert an argument to a number between zero
+        and one, both excluded."""
+        try:
+            number = float(value)
+        except ValueError:
+            number = 0
+        if not 0 < number < 1:
+            raise ap.ArgumentTypeError(
+                '{} is not between 0 and 1'.format(value))
+        return number
+
     arg_parser = ap.ArgumentParser(
         prog='bikeshare-analyzer',
         description=
@@ -789,15 +3423,68 @@ def parse_arguments():
         description='valid subcommands',
         help='command help',
         dest='command')
-    test_command = sub_arg_parser.add_parser('test')
+    # arguments shared by both commands
+    common_parser = ap.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        '--cache-dir',
+        help='The directory to store the columnar binary cache in.',
+        default=options['cache_dir'])
+    common_parser.add_argument(
+        '--no-cache',
+        help='Always read the CSV files and do not use the cache '
+        'directory.',
+        action='store_true')
+    common_parser.add_argument(
+        '--jobs',
+        help='The number of processes used to aggregate the data.',
+        type=get_positive_int,
+        default=options['jobs'])
+    common_parser.add_argument(
+        '--timings',
+        help='Export the timings of all steps and statistics to this file, '
+        'as CSV if it ends with .csv, otherwise as JSON.')
+    common_parser.add_argument(
+        '--profile', help='Write cProfile statistics to this file.')
+    common_parser.add_argument(
+        '--trace-memory',
+        help='Measure the peak memory of every step using tracemalloc.',
+        action='store_true')
+
+    test_command = sub_arg_parser.add_parser(
+        'test',
+        parents=[common_parser],
+        formatter_class=ap.ArgumentDefaultsHelpFormatter)
     analyze_command = sub_arg_parser.add_parser(
-        'analyze', formatter_class=ap.ArgumentDefaultsHelpFormatter)
+        'analyze',
+        parents=[common_parser],
+        formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    serve_command = sub_arg_parser.add_parser(
+        'serve',
+        parents=[common_parser],
+        formatter_class=ap.ArgumentDefaultsHelpFormatter)
+
+    # the server listens locally and keeps the cities loaded
+    serve_command.add_argument(
+        '--host', help='The address to listen on.', default=options['host'])
+    serve_command.add_argument(
+        '--port', help='The port to listen on.', type=int,
+        default=options['port'])
+    serve_command.add_argument(
+        '--workers',
+        help='The number of requests answered at once.',
+        type=get_positive_int,
+        default=options['workers'])
+    serve_command.add_argument(
+        '--memory-budget',
+        help='The megabytes the loaded cities may use.',
+        type=float,
+        default=options['session_memory_budget'] / 1024**2)
 
     # only the analyze command needs additional arguments
     analyze_command.add_argument(
         '--city',
-        help='The name of the city to analyze data from.',
-        choices=[city_dict['name'] for city_dict in city_data],
+        help='The name of the city to analyze data from or "all".',
+        choices=[city_dict['name'] for city_dict in city_data] + ['all'],
         default=city_data[0]['name'])
     analyze_command.add_argument(
         '--filter',
@@ -815,15 +3502,113 @@ def parse_arguments():
         help='If filtered by weekday, the weekday to use.',
         choices=[calendar.day_name[day] for day in options['allowed_days']],
         default='Monday')
+    analyze_command.add_argument(
+        '--stream',
+        help='Read the file in chunks for files larger than the memory.',
+        action='store_true')
+    analyze_command.add_argument(
+        '--chunk-size',
+        help='If streamed, the number of rows per chunk.',
+        type=get_positive_int,
+        default=options['chunk_size'])
+    analyze_command.add_argument(
+        '--approximate',
+        help='Stream the file and approximate the station statistics in '
+        'bounded memory. Implies --stream.',
+        action='store_true')
+    analyze_command.add_argument(
+        '--sketch-size',
+        help='If approximated, the number of stations and trips counted.',
+        type=get_positive_int,
+        default=options['sketch_size'])
+    analyze_command.add_argument(
+        '--sketch-error',
+        help='If approximated, the error of the trip counts relative to the '
+        'number of rows.',
+        type=get_fraction,
+        default=options['sketch_error'])
+    analyze_command.add_argument(
+        '--incremental',
+        help='Only parse the rows appended since the last run and merge '
+        'them into the aggregates stored in the cache directory.',
+        action='store_true')
+    analyze_command.add_argument(
+        '--cube',
+        help='Roll the statistics up from the aggregate cube of the city, '
+        'which is built once and stored in the cache directory.',
+        action='store_true')
+    analyze_command.add_argument(
+        '--result-cache',
+        help='Store the statistics in the cache directory and print them '
+        'again without loading the file while the file and the options do '
+        'not change. Their timings are then printed as (cached).',
+        action='store_true')
+    analyze_command.add_argument(
+        '--result-cache-size',
+        help='The megabytes the statistics stored in the cache directory '
+        'may use.',
+        type=float,
+        default=options['result_cache_size'] / 1024**2)
+    analyze_command.add_argument(
+        '--result-cache-age',
+        help='The hours the statistics are stored in the cache directory.',
+        type=float,
+        default=options['result_cache_age'] / 3600)
     args = arg_parser.parse_args()
 
+    # cache and processes
+    if args.command is not None:
+        options['cache_dir'] = None if args.no_cache else args.cache_dir
+        options['jobs'] = args.jobs
+
+        # instrumentation
+        options['timings_file'] = args.timings
+        options['profile_file'] = args.profile
+        options['trace_memory'] = args.trace_memory
+
     if args.command == 'test':
         return test
+    elif args.command == 'serve':
+        options['host'] = args.host
+        options['port'] = args.port
+        options['workers'] = args.workers
+        options['session_memory_budget'] = int(args.memory_budget * 1024**2)
+        return serve
     else:
         # change options according to the args given
+        # streaming
+        options['stream'] = args.stream or args.approximate
+        options['chunk_size'] = args.chunk_size
+        options['approximate'] = args.approximate
+        options['sketch_size'] = args.sketch_size
+        options['sketch_error'] = args.sketch_error
+        options['result_cache'] = args.result_cache
+        options['result_cache_size'] = int(args.result_cache_size * 1024**2)
+        options['result_cache_age'] = args.result_cache_age * 3600
+
         # city
-        if (args.city and options['city_of_interest']['name'] != args.city):
+        options['all_cities'] = args.city == 'all'
+        if (args.city and not options['all_cities']
+                and options['city_of_interest']['name'] != args.city):
             options['city_of_interest'] = city_data[find_city_dict(args.city)]
+        if options['stream'] and (options['all_cities']
+                                  or options['jobs'] > 1):
+            arg_parser.error('--stream and --approximate cannot be combined '
+                             'with --city all or --jobs')
+        options['incremental'] = args.incremental
+        options['cube'] = args.cube
+        if (options['incremental'] or options['cube']) and (
+                options['stream'] or options['all_cities']
+                or options['jobs'] > 1 or options['cache_dir'] is None
+                or options['incremental'] == options['cube']):
+            arg_parser.error('--incremental and --cube cannot be combined '
+                             'with each other, --stream, --approximate, '
+                             '--city all, --jobs or --no-cache')
+        if options['result_cache'] and (options['all_cities']
+                                        or options['jobs'] > 1
+                                        or options['cache_dir'] is None):
+            arg_parser.error('--result-cache cannot be combined with '
+                             '--city all, --jobs or --no-cache')
 
         # filter
         if (args.filter and options['filter_type'] != args.filter):
@@ -851,10 +3636,64 @@ def parse_arguments():
                     k for k, v in enumerate(calendar.day_name)
                     if v == args.weekday
                 ][0]
+
+        # with --jobs the months of a single city are aggregated by the
+        # processes as well
+        if options['all_cities'] or options['jobs'] > 1:
+            return analyze_parallel
         return analyze
     # ------------------------------------------------------ parse_arguments()
 
 
+def create_options(city_data):
+    """Creates the options passed around the functions holding the defaults
+    of all settings.
+
+    Args:
+        city_data (tuple): the cities to choose from, dicts holding the name
+                           of the city and the name of its CSV file
+
+    Returns:
+        dict: the options analyzing the first city without any filter
+    """
+    # the city to use and the filter are stored in a dictionary which is
+    # passed around the functions
+    return {
+        'city_data': city_data,
+        'city_of_interest': city_data[0],
+        'filter_type': None,
+        'month_of_interest': 1,
+        'day_of_interest': 0,
+        'allowed_filters': ('None', 'Month', 'Day', 'Both'),
+        'allowed_months': list(range(1, 7)),
+        'allowed_days': list(range(0, 7)),
+        'interactive': True,
+        'cache_dir': '.bikeshare_cache',
+        'result_cache': False,
+        'stream': False,
+        'chunk_size': 1000000,
+        'approximate': False,
+        'sketch_size': 1000,
+        'sketch_error': 0.0001,
+        'sketch_confidence': 0.99,
+        'incremental': False,
+        'cube': False,
+        'all_cities': False,
+        'jobs': 1,
+        'session': None,
+        'session_memory_budget': SESSION_MEMORY_BUDGET,
+        'result_cache_size': RESULT_CACHE_SIZE,
+        'result_cache_age': RESULT_CACHE_AGE,
+        'host': '127.0.0.1',
+        'port': 8017,
+        'workers': 4,
+        'timings_file': None,
+        'profile_file': None,
+        'trace_memory': False,
+    }
+    # ------------------------------------------------------- create_options()
+
+
 # Start main -----------------------------------------------------------------
 if __name__ == "__main__":
     """Instead of using only an interactive part I decided to implement both:
@@ -881,22 +3720,11 @@ if __name__ == "__main__":
             'file': 'washington.csv'
         },
     )
-    # the city to use and the filter are stored in a dictionary which is
-    # passed around the functions
-    options = {
-        'city_of_interest': city_data[0],
-        'filter_type': None,
-        'month_of_interest': 1,
-        'day_of_interest': 0,
-        'allowed_filters': ('None', 'Month', 'Day', 'Both'),
-        'allowed_months': list(range(1, 7)),
-        'allowed_days': list(range(0, 7)),
-        'interactive': True,
-    }
+    options = create_options(city_data)
 
     if len(sys.argv) == 1:
         show_menu()
     else:
         options['interactive'] = False
         action = parse_arguments()
-        action(options)
+        run_instrumented(action, options)
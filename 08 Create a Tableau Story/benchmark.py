@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""Benchmark gencsv.py on synthetic pisa 2012 databases.
+
+Databases of the given sizes are generated once with the layout of
+pisa2012.csv, then every stage of the conversion is timed and the peak
+memory of every run is taken from a fresh process, e.g.
+
+    python benchmark.py --rows 1e5 1e6 --output before.json
+    python benchmark.py --rows 1e5 1e6 --baseline before.json
+
+Any version of gencsv.py, like the original script, can also be run end to
+end in a fresh process. Its output is checked against the digests stored
+from the original script, e.g.
+
+    python benchmark.py --script original/gencsv.py --store-expected \
+        --output before.json
+    python benchmark.py --script gencsv.py --baseline before.json
+"""
+
+import os
+import csv
+import sys
+import json
+import shutil
+import hashlib
+import resource
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+
+import gencsv
+
+
+# COUNTRIES NOT ATTENDED TO THE DIGITAL ASSESSMENT
+other_countries = [
+    'Albania', 'Argentina', 'Brazil', 'Indonesia', 'Kazakhstan', 'Tunisia',
+    'United Arab Emirates', 'United States of America', 'Viet Nam'
+]
+
+# SHARE OF MISSING ANSWERS OF THE ICT QUESTIONS
+missing_share = 0.25
+
+# ROWS GENERATED AND WRITTEN AT ONCE
+generator_chunksize = 100000
+
+# STAGES OF THE CONVERSION TIMED ONE BY ONE
+stages = ['read', 'filter', 'recode', 'derive', 'encode', 'write']
+
+# DIGESTS OF THE TABLEAU DATA THE ORIGINAL SCRIPT WRITES FOR EVERY DATABASE
+expected_file = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmark_expected.json')
+
+
+def get_header(fillers):
+    """Return the columns of a database with fillers unused columns."""
+    unused = ['ST{:03d}Q01'.format(number) for number in range(fillers)]
+    half = fillers // 2
+    return (['', 'CNT', 'SUBNATIO', 'OECD'] + unused[:half] +
+            [col for col in gencsv.cols if col.startswith(('IC', 'PV'))] +
+            unused[half:] + ['W_FSTUWT'])
+
+
+def get_answers(rng, answers, size):
+    """Return random answers of one question, some of them missing."""
+    choices = np.array(list(answers) + ['NA'], dtype=object)
+    weights = np.full(len(choices), (1 - missing_share) / len(answers))
+    weights[-1] = missing_share
+    return choices[rng.choice(len(choices), size, p=weights)]
+
+
+def generate_pisa(file_name, rows, fillers, seed):
+    """Write a database of random students sorted by country."""
+    rng = np.random.default_rng(seed)
+    names = np.array(sorted(gencsv.countries + other_countries), dtype=object)
+    header = get_header(fillers)
+
+    for first_row in range(0, rows, generator_chunksize):
+        size = min(generator_chunksize, rows - first_row)
+        numbers = np.arange(first_row, first_row + size)
+        chunk = {'': numbers + 1, 'CNT': names[numbers * len(names) // rows]}
+        chunk['SUBNATIO'] = chunk['CNT']
+        chunk['OECD'] = np.array(['OECD', 'Non-OECD'], dtype=object)[
+            rng.integers(0, 2, size)]
+        for col in header:
+            if col.startswith(('IC01', 'IC02')):
+                chunk[col] = get_answers(rng, gencsv.usage_values, size)
+            elif col.startswith('IC10'):
+                chunk[col] = get_answers(rng, gencsv.time_values, size)
+            elif col.startswith('PV'):
+                chunk[col] = np.round(rng.normal(480, 100, size), 4)
+            elif col.startswith('ST'):
+                chunk[col] = rng.integers(1, 5, size)
+        chunk['W_FSTUWT'] = np.round(rng.uniform(1, 60, size), 4)
+        pd.DataFrame(chunk, columns=header).to_csv(
+            file_name, mode='w' if first_row == 0 else 'a',
+            header=first_row == 0, index=False, encoding='cp1252',
+            quoting=csv.QUOTE_NONNUMERIC)
+
+
+def generate_data(data_dir, rows, fillers, seed):
+    """Return the database of the given size, generated if it is missing.
+
+    A json file next to the database remembers the parameters it was
+    generated with, so it is only generated again if they change.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    file_name = os.path.join(data_dir, 'pisa{}.csv'.format(rows))
+    parameters_file = file_name[:-len('.csv')] + '.json'
+    parameters = {'rows': rows, 'fillers': fillers, 'seed': seed}
+    try:
+        with open(parameters_file) as parameters_json:
+            up_to_date = json.load(parameters_json) == parameters
+    except (OSError, ValueError):
+        up_to_date = False
+    if up_to_date and os.path.exists(file_name):
+        return file_name
+
+    print('Generating {} students ...'.format(rows))
+    generate_pisa(file_name, rows, fillers, seed)
+    with open(parameters_file, 'w') as parameters_json:
+        json.dump(parameters, parameters_json)
+    return file_name
+
+
+def get_peak_memory():
+    """Return the peak resident memory of this process in bytes."""
+    # LINUX KEEPS THE PEAK OF THE PARENT PROCESS IN RU_MAXRSS, SO READ THE
+    # PEAK OF THIS PROCESS FROM ITS STATUS
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # MACOS REPORTS BYTES, OTHERS KILOBYTES
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def convert_stages(file_name, output, file_format, chunksize):
+    """Return the seconds of every stage of converting a database.
+
+    The stages are run like gencsv.write() does, the write stage is the
+    time left after all others.
+    """
+    seconds = dict.fromkeys(stages, 0.0)
+    writer = gencsv.writers[file_format]
+    columns = gencsv.tableau_columns
+
+    def encoded_chunks():
+        start = timer()
+        chunks = gencsv.read_pisa(
+            file_name, chunksize, gencsv.get_input_columns(columns))
+        for number, df in enumerate(chunks):
+            lap = timer()
+            seconds['read'] += lap - start
+            df = gencsv.filter_countries(df, gencsv.countries)
+            start, lap = lap, timer()
+            seconds['filter'] += lap - start
+            recoded = gencsv.recode(df, columns)
+            start, lap = lap, timer()
+            seconds['recode'] += lap - start
+            df = gencsv.derive(recoded, columns)
+            start, lap = lap, timer()
+            seconds['derive'] += lap - start
+            part = writer['encode'](df, number == 0)
+            start, lap = lap, timer()
+            seconds['encode'] += lap - start
+            yield part
+            start = timer()
+
+    start = timer()
+    writer['write'](encoded_chunks(), output)
+    seconds['write'] = timer() - start - sum(seconds.values())
+    return seconds
+
+
+def profile(function, *args):
+    """Return the seconds and the peak memory of a function call.
+
+    The base memory is the peak before the call, mostly the imported
+    modules.
+    """
+    base_memory = get_peak_memory()
+    start = timer()
+    result = function(*args)
+    seconds = timer() - start
+    return {
+        'seconds': result if isinstance(result, dict) else seconds,
+        'base_memory': base_memory,
+        'peak_memory': get_peak_memory()
+    }
+
+
+def run_isolated(repeat, function, *args):
+    """Return the best seconds and the peak memory of a function.
+
+    Every run starts a new process so the peak memory of one run does not
+    hide the peak of the next.
+    """
+    runs = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            runs.append(executor.submit(profile, function, *args).result())
+    if isinstance(runs[0]['seconds'], dict):
+        seconds = {
+            stage: min(run['seconds'][stage] for run in runs)
+            for stage in stages
+        }
+    else:
+        seconds = min(run['seconds'] for run in runs)
+    return {
+        'seconds': seconds,
+        'base_memory': min(run['base_memory'] for run in runs),
+        'peak_memory': max(run['peak_memory'] for run in runs)
+    }
+
+
+def get_file_digest(file_name):
+    """Return the sha1 digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as content:
+        for block in iter(lambda: content.read(1024 ** 2), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def run_script(script, file_name, repeat, script_args):
+    """Return the best seconds, the peak memory and the output digest of a
+    gencsv.py run end to end.
+
+    Every run starts the script in a new process in a directory holding
+    the database as pisa2012.csv, where it writes tableau.csv like the
+    original script does.
+    """
+    work_dir = os.path.join(os.path.dirname(file_name), 'script')
+    os.makedirs(work_dir, exist_ok=True)
+    database = os.path.join(work_dir, 'pisa2012.csv')
+    if os.path.lexists(database):
+        os.remove(database)
+    try:
+        os.link(file_name, database)
+    except OSError:
+        shutil.copyfile(file_name, database)
+    output = os.path.join(work_dir, 'tableau.csv')
+
+    runs = []
+    for _ in range(repeat):
+        if os.path.exists(output):
+            os.remove(output)
+        start = timer()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(script)] + script_args,
+            cwd=work_dir, stdout=subprocess.DEVNULL)
+        # THE USAGE OF THIS CHILD ONLY, NOT THE PEAK OF ALL CHILDREN
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = timer() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise RuntimeError('{} failed with exit code {}'.format(
+                script, process.returncode))
+        # MACOS REPORTS BYTES, OTHERS KILOBYTES
+        scale = 1 if sys.platform == 'darwin' else 1024
+        runs.append({'seconds': seconds,
+                     'peak_memory': usage.ru_maxrss * scale})
+    return {
+        'seconds': min(run['seconds'] for run in runs),
+        'base_memory': 0,
+        'peak_memory': max(run['peak_memory'] for run in runs),
+        'digest': get_file_digest(output)
+    }
+
+
+def get_expected_key(rows, args):
+    """Return the key of the expected digest of a generated database."""
+    return '{} rows, {} fillers, seed {}'.format(rows, args.fillers, args.seed)
+
+
+def aggregate_pisa(file_name, output, file_format, chunksize):
+    """Write the aggregate cube of a database like gencsv.py does."""
+    writer = gencsv.writers[file_format]
+    cube = gencsv.aggregate(gencsv.scan(file_name, chunksize))
+    writer['write']([writer['encode'](cube, True)], output)
+
+
+def run_benchmarks(file_name, rows, args):
+    """Return the results of all benchmarks of one database."""
+    results = {}
+
+    def add_result(name, result):
+        seconds = result['seconds']
+        if isinstance(seconds, dict):
+            for stage in stages:
+                add_result('{} {}'.format(name, stage),
+                           dict(result, seconds=seconds[stage]))
+            seconds = sum(seconds.values())
+        result = dict(result, seconds=seconds, rows=rows)
+        result['rows_per_second'] = rows / max(seconds, 1e-9)
+        results['{} {}'.format(rows, name)] = result
+        print('{:>10} {:<28} {:>10.4f}s {:>14,.0f} rows/s {:>9.1f} MB'.format(
+            rows, name, seconds, result['rows_per_second'],
+            result['peak_memory'] / 1024 ** 2))
+
+    if args.script:
+        script_args = []
+        if args.chunksize:
+            script_args = ['--chunksize', str(args.chunksize)]
+        add_result('end to end', run_script(
+            args.script, file_name, args.repeat, script_args))
+        return results
+
+    output = os.path.join(os.path.dirname(file_name), 'tableau')
+    for file_format in sorted(gencsv.writers):
+        name = 'convert {}'.format(file_format)
+        add_result(name, run_isolated(
+            args.repeat, convert_stages, file_name,
+            output + '.' + file_format, file_format, args.chunksize))
+    if args.jobs > 1:
+        add_result('convert csv {} jobs'.format(args.jobs), run_isolated(
+            args.repeat, gencsv.write, gencsv.scan(file_name),
+            output + '.csv', 'csv', args.jobs))
+    add_result('aggregate csv', run_isolated(
+        args.repeat, aggregate_pisa, file_name, output + '_cube.csv', 'csv',
+        args.chunksize))
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    """Print the change against a baseline and return the regressions."""
+    regressions = 0
+    print('\nCompared to the baseline:')
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:<39} {:>11}'.format(name, 'new'))
+            continue
+        ratio = result['seconds'] / max(baseline[name]['seconds'], 1e-9)
+        memory_ratio = result['peak_memory'] / max(
+            baseline[name]['peak_memory'], 1)
+        slower = ratio > 1 + tolerance
+        regressions += slower
+        print('{:<39} {:>10.2f}x time {:>7.2f}x memory{}'.format(
+            name, ratio, memory_ratio, '  SLOWER' if slower else ''))
+    return regressions
+
+
+def check_digests(results, args):
+    """Print if the outputs match the expected digests, return mismatches.
+
+    With --store-expected the digests are stored as the expected ones
+    instead.
+    """
+    try:
+        with open(expected_file) as expected_json:
+            expected = json.load(expected_json)
+    except FileNotFoundError:
+        expected = {}
+
+    mismatches = 0
+    print('\nOutput of {}:'.format(args.script))
+    for rows in args.rows:
+        key = get_expected_key(rows, args)
+        digest = results['{} end to end'.format(rows)]['digest']
+        if args.store_expected:
+            expected[key] = digest
+            state = 'stored'
+        elif key not in expected:
+            state = 'no expected digest'
+        elif expected[key] == digest:
+            state = 'matches'
+        else:
+            mismatches += 1
+            state = 'DIFFERS'
+        print('{:<39} {}'.format(key, state))
+
+    if args.store_expected:
+        with open(expected_file, 'w') as expected_json:
+            json.dump(expected, expected_json, indent=2, sort_keys=True)
+    return mismatches
+
+
+def parse_arguments():
+    """Return the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--rows', nargs='+', type=lambda value: int(float(value)),
+        default=[10000, 100000],
+        help='the numbers of students of the databases, e.g. 1e5 1e6')
+    parser.add_argument(
+        '--fillers', type=int, default=100,
+        help='the number of unused columns, the real database has about 600')
+    parser.add_argument(
+        '--seed', type=int, default=2012, help='the seed of the generator')
+    parser.add_argument(
+        '--data-dir', default='benchmark_data',
+        help='the directory of the generated databases and outputs')
+    parser.add_argument(
+        '--chunksize', type=int,
+        help='convert the databases in chunks of this many rows')
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='also convert the databases in this many processes')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='the number of runs of every benchmark, the best time counts')
+    parser.add_argument('--output', help='store the results in this json file')
+    parser.add_argument(
+        '--baseline', help='compare the results to this json file')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='the slowdown accepted when comparing, 0.1 is 10%%')
+    parser.add_argument(
+        '--script',
+        help='run this gencsv.py end to end in a fresh process instead of '
+        'timing the stages, and check its output')
+    parser.add_argument(
+        '--store-expected', action='store_true',
+        help='store the digests of the output of --script as the expected '
+        'ones, which should be the original script')
+    args = parser.parse_args()
+    if args.store_expected and not args.script:
+        parser.error('--store-expected needs --script')
+    return args
+
+
+def main():
+    """Benchmark gencsv.py on databases of all sizes."""
+    args = parse_arguments()
+    results = {}
+    for rows in args.rows:
+        file_name = generate_data(args.data_dir, rows, args.fillers, args.seed)
+        results.update(run_benchmarks(file_name, rows, args))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    failed = False
+    if args.script:
+        failed = check_digests(results, args) > 0
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare_results(results, json.load(baseline), args.tolerance):
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
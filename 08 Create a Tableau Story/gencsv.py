@@ -1,22 +1,32 @@
 #!/usr/bin/env python
-"""Generate Tableau data from pisa 2012 database."""
+"""Generate Tableau data from pisa 2012 database.
 
-import pandas as pd
+Besides running it as script, the conversion can be planned lazily and run
+later, reading only the countries and columns needed, e.g.
 
+    plan = scan('pisa2012.csv', index=load_index('pisa2012.csv', 'pisa.idx'))
+    plan = project(where_countries(plan, ['Japan']), ['math_score'])
+    df = collect(plan)
 
-def return_time_category(value):
-    """Return category of time value."""
-    category = {
-        1: 'Once or twice a month',
-        2: 'Once or twice a week',
-        3: 'Almost every day',
-        4: 'Every day',
-        0: 'Never or hardly ever'
-    }
-    if not pd.isnull(value):
-        return category.get(value)
-    else:
-        return value
+or aggregated by country into a cube of weighted scores with aggregate(plan).
+
+Writing parquet needs the optional pyarrow package (pip install pyarrow),
+csv output works with pandas alone.
+"""
+
+import io
+import os
+import re
+import json
+import shutil
+import hashlib
+import inspect
+import argparse
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 
 
 # COUNTRIES ATTENDED TO THE DIGITAL ASSESSMENT
@@ -43,6 +53,9 @@ cols = [
     'PV4SCIE', 'PV5SCIE'
 ]
 
+# WEIGHT OF EVERY STUDENT, ONLY IMPORTED TO AGGREGATE THE SCORES
+weight_col = 'W_FSTUWT'
+
 # COUNTRY NAMES TO FIX/REPLACE
 country_values = {
     'Korea': 'South Korea',
@@ -53,77 +66,832 @@ country_values = {
 
 # ICT CODINGS
 usage_values = {
-    'No': '0',
-    'Yes, but I don’t use it': '1',
-    'Yes, and I use it': '2'
+    'No': 0,
+    'Yes, but I don’t use it': 1,
+    'Yes, and I use it': 2
 }
 
 # TIME CODINGS
 time_values = {
-    'Never or hardly ever': '0',
-    'Once or twice a month': '1',
-    'Once or twice a week': '2',
-    'Almost every day': '3',
-    'Every day': '4'
+    'Never or hardly ever': 0,
+    'Once or twice a month': 1,
+    'Once or twice a week': 2,
+    'Almost every day': 3,
+    'Every day': 4
+}
+
+# CODE OF MISSING VALUES, LOWER THAN ALL CODES ABOVE
+missing_code = -1
+
+# ICT AVAILABILITY AND USAGE BY HIGHEST USAGE CODE, MISSING LAST
+avail_values = np.array([0.0, 1.0, 1.0, np.nan])
+used_values = np.array([0.0, 0.0, 1.0, np.nan])
+
+# TIME CATEGORIES BY TIME CODE, MISSING LAST
+time_categories = np.array(
+    sorted(time_values, key=time_values.get) + [np.nan], dtype=object)
+
+# TYPES OF THE TABLEAU DATA IN COLUMNAR FORMATS
+columnar_types = {
+    'country': 'category',
+    'oecd': 'category',
+    'ict_avail_home': 'Int8',
+    'ict_avail_school': 'Int8',
+    'ict_used_home': 'Int8',
+    'ict_used_school': 'Int8',
+    'ict_usage_time_school': pd.CategoricalDtype(
+        time_categories[:-1], ordered=True),
+    'math_score': 'float64',
+    'read_score': 'float64',
+    'scie_score': 'float64'
+}
+
+# LARGEST BYTE RANGE OF THE DATABASE A JOB PROCESSES AT ONCE
+range_size = 64 * 1024 ** 2
+
+# PARSER TYPES OF THE IMPORTED COLUMNS, SCORES AND WEIGHTS ARE NUMBERS
+col_types = {
+    col: 'float64' if col.startswith(('PV', 'W_')) else 'category'
+    for col in cols + [weight_col]
+}
+
+# BLOCK OF INPUT COLUMNS EVERY COLUMN OF THE TABLEAU DATA IS DERIVED FROM
+column_blocks = {
+    'country': 'CNT',
+    'oecd': 'OECD',
+    'ict_avail_home': 'IC01',
+    'ict_avail_school': 'IC02',
+    'ict_used_home': 'IC01',
+    'ict_used_school': 'IC02',
+    'ict_usage_time_school': 'IC10',
+    'math_score': 'MATH',
+    'read_score': 'READ',
+    'scie_score': 'SCIE',
+    'weight': weight_col
 }
 
-# READ FILE
-df = pd.read_csv(
-    'pisa2012.csv', encoding='cp1252', usecols=cols, dtype=object,
-    memory_map=True)
+# COLUMNS OF THE TABLEAU DATA
+tableau_columns = [column for column in column_blocks if column != 'weight']
+
+# DIMENSIONS OF THE AGGREGATE CUBE, THE SCORES ARE ITS MEASURES
+cube_dimensions = [
+    'country', 'oecd', 'ict_avail_home', 'ict_avail_school', 'ict_used_home',
+    'ict_used_school', 'ict_usage_time_school'
+]
+cube_scores = ['math_score', 'read_score', 'scie_score']
+
+
+def get_block_columns(block):
+    """Return the input columns of a block like IC01 or MATH."""
+    return [
+        col for col in cols + [weight_col]
+        if col.startswith(block) or col.endswith(block)
+    ]
+
+
+def get_input_columns(columns):
+    """Return the input columns needed to derive the given columns."""
+    blocks = {'CNT'} | {column_blocks[column] for column in columns}
+    return [col for col in cols + [weight_col] if any(
+        col in get_block_columns(block) for block in blocks)]
+
+
+def decode(column, coding, out):
+    """Write the codes of a categorical column as small integers to out."""
+    categories = column.cat.categories
+    unknown = categories[~categories.isin(list(coding))]
+    if len(unknown) > 0:
+        raise ValueError('Unknown values in {}: {}'.format(
+            column.name, ', '.join(unknown)))
+
+    # ONE LOOKUP PER CATEGORY, MISSING VALUES (CODE -1) TAKE THE LAST ENTRY
+    lookup = np.array(
+        [coding[category] for category in categories] + [missing_code],
+        dtype='int8')
+    np.take(lookup, column.cat.codes.values, out=out, mode='wrap')
+
+
+def decode_columns(df, block, coding):
+    """Return the codes of a block as contiguous matrix, a row per column."""
+    block_cols = get_block_columns(block)
+    codes = np.empty((len(block_cols), len(df)), dtype='int8')
+    for row, col in enumerate(block_cols):
+        decode(df[col], coding, codes[row])
+    return codes
+
+
+def get_mean_code(codes):
+    """Return the rounded mean code per student, ignoring missing ones."""
+    missing = np.count_nonzero(codes == missing_code, axis=0)
+    counts = len(codes) - missing
+
+    # THE SUM INCLUDES THE MISSING CODES, SO TAKE THEM OUT AGAIN
+    totals = codes.sum(axis=0, dtype='int16') - missing_code * missing
+    means = np.full(codes.shape[1], missing_code, dtype='int8')
+    rows = counts > 0
+    means[rows] = np.round(totals[rows] / counts[rows])
+    return means
+
+
+def read_pisa(file_name, chunksize=None, usecols=cols):
+    """Return the pisa rows, all at once or in chunks of chunksize rows."""
+    reader = pd.read_csv(
+        file_name, encoding='cp1252', usecols=usecols, dtype=col_types,
+        memory_map=True, chunksize=chunksize)
+    if chunksize is None:
+        return [reader]
+    return reader
+
+
+def get_byte_ranges(file_name, count):
+    """Return count or more ranges of whole lines following the header.
+
+    The ranges are split at line ends, so no field may contain a newline.
+    """
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as pisa:
+        pisa.readline()
+        offsets = [pisa.tell()]
+        count = max(count, -(-(size - offsets[0]) // range_size))
+        for number in range(1, count):
+            # CONTINUE TO THE END OF THE LINE THE SPLIT FALLS INTO
+            pisa.seek(max(offsets[0] + (size - offsets[0]) * number // count,
+                          offsets[-1]))
+            pisa.readline()
+            offsets.append(pisa.tell())
+        offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:])
+            if start < end]
+
+
+def read_range(file_name, start, end, first_row=0, usecols=cols):
+    """Return the pisa rows of a range of lines, numbered from first_row."""
+    with open(file_name, 'rb') as pisa:
+        names = pisa.readline()
+        pisa.seek(start)
+        lines = pisa.read(end - start)
+    df = pd.read_csv(
+        io.BytesIO(names + lines), encoding='cp1252', usecols=usecols,
+        dtype=col_types)
+    df.index += first_row
+    return df
+
+
+def split_range(file_name, start, end, first_row, chunksize):
+    """Return a range of lines split into ranges of chunksize lines.
+
+    The line ends are scanned in blocks, so only the last range may hold
+    fewer lines and an empty range is kept as it is.
+    """
+    ranges = []
+    lines = 0
+    with open(file_name, 'rb') as pisa:
+        pisa.seek(start)
+        offset = start
+        while offset < end:
+            block = pisa.read(min(range_size, end - offset))
+            ends = np.flatnonzero(
+                np.frombuffer(block, dtype='uint8') == ord('\n')) + offset + 1
+
+            # SPLIT AFTER EVERY CHUNKSIZE-TH LINE, COUNTING FROM THE LAST SPLIT
+            for split in ends[chunksize - lines - 1::chunksize]:
+                ranges.append([start, int(split), first_row])
+                start, first_row = int(split), first_row + chunksize
+            lines = (lines + len(ends)) % chunksize
+            offset += len(block)
+    if start < end or not ranges:
+        ranges.append([start, end, first_row])
+    return ranges
+
+
+def read_ranges(file_name, ranges, usecols=cols, chunksize=None):
+    """Return the pisa rows of every range of lines in turn.
+
+    Given a chunksize, the ranges are read in chunks of that many rows.
+    """
+    for lines in ranges:
+        if chunksize is not None:
+            lines = split_range(file_name, *lines, chunksize)
+        else:
+            lines = [lines]
+        for start, end, first_row in lines:
+            yield read_range(file_name, start, end, first_row, usecols)
+
+
+def transform_range(file_name, start, end, first, file_format,
+                    selected=None, columns=None):
+    """Return the tableau data of a range of lines encoded for a format."""
+    df = read_range(
+        file_name, start, end,
+        usecols=get_input_columns(columns or tableau_columns))
+    return writers[file_format]['encode'](
+        transform(df, selected, columns), first)
+
+
+def encode_csv(df, first):
+    """Return tableau data as csv text, with a header if it comes first."""
+    return df.to_csv(index=False, header=first)
+
+
+def write_csv(parts, file_name):
+    """Write the csv text of all parts to a file."""
+    with open(file_name, 'w', encoding='utf-8', newline='') as output:
+        for text in parts:
+            output.write(text)
+
+
+def get_parquet_schema():
+    """Return the schema of the parquet file, encoding text as dictionary."""
+    # PYARROW IS ONLY IMPORTED WHEN WRITING PARQUET
+    import pyarrow as pa
+
+    text = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('country', text),
+        ('oecd', text),
+        ('ict_avail_home', pa.int8()),
+        ('ict_avail_school', pa.int8()),
+        ('ict_used_home', pa.int8()),
+        ('ict_used_school', pa.int8()),
+        ('ict_usage_time_school', pa.dictionary(
+            pa.int32(), pa.string(), ordered=True)),
+        ('math_score', pa.float64()),
+        ('read_score', pa.float64()),
+        ('scie_score', pa.float64()),
+    ])
+
+
+def encode_parquet(df, first):
+    """Return tableau data as arrow table with dictionary encoded columns."""
+    import pyarrow as pa
+
+    # COLUMNS NOT IN THE SCHEMA, LIKE THE MEASURES OF THE CUBE, KEEP THEIR
+    # NUMPY TYPE
+    schema = get_parquet_schema()
+    return pa.Table.from_pandas(
+        df.astype({
+            column: columnar_types[column]
+            for column in df if column in columnar_types
+        }),
+        schema=pa.schema([
+            schema.field(column) if column in schema.names else pa.field(
+                column, pa.from_numpy_dtype(df[column].dtype))
+            for column in df
+        ]),
+        preserve_index=False)
+
+
+def write_parquet(parts, file_name):
+    """Write the arrow tables of all parts to a compressed parquet file."""
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for table in parts:
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    file_name, table.schema, compression='zstd')
+            writer.write_table(table)
+        if writer is None:
+            writer = pq.ParquetWriter(
+                file_name, get_parquet_schema(), compression='zstd')
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def get_fingerprint(file_name):
+    """Return size and modification time of a file to detect changes."""
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_index(file_name):
+    """Return the ranges of lines of every country in the database.
+
+    Every country maps to a list of [start, end, first_row] holding the
+    byte offsets of its lines and the number of its first row.
+    """
+    # OFFSETS OF ALL LINE ENDS, SCANNED IN BLOCKS
+    ends = []
+    size = 0
+    with open(file_name, 'rb') as pisa:
+        for block in iter(lambda: pisa.read(range_size), b''):
+            ends.append(np.flatnonzero(
+                np.frombuffer(block, dtype='uint8') == ord('\n')) + size)
+            size += len(block)
+    starts = np.concatenate(ends) + 1
+    if len(starts) == 0 or starts[-1] < size:
+        starts = np.append(starts, size)
+
+    # THE COUNTRY OF EVERY ROW, WHICH ARE THE LINES AFTER THE HEADER
+    country = pd.read_csv(
+        file_name, encoding='cp1252', usecols=['CNT'], dtype='category',
+        memory_map=True).CNT
+    codes = country.cat.codes.values
+    if len(starts) != len(codes) + 1:
+        raise ValueError('{} has rows spanning several lines'.format(
+            file_name))
+
+    # ONE RANGE PER RUN OF ROWS OF THE SAME COUNTRY
+    runs = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    ranges = {}
+    for first, last in zip(np.r_[0, runs], np.r_[runs, len(codes)]):
+        if first < last and codes[first] != missing_code:
+            ranges.setdefault(country.cat.categories[codes[first]], []).append(
+                [int(starts[first]), int(starts[last]), int(first)])
+    return {'input': get_fingerprint(file_name), 'countries': ranges}
+
+
+def load_index(file_name, index_file):
+    """Return the index of the database, building it if out of date."""
+    try:
+        with open(index_file) as index:
+            index = json.load(index)
+    except FileNotFoundError:
+        index = None
+    if index is None or index['input'] != get_fingerprint(file_name):
+        index = build_index(file_name)
+        with open(index_file, 'w') as output:
+            json.dump(index, output)
+    return index
 
-# ONLY HOLD ROWS OF ABOVE COUNTRIES
-df = df.loc[df.CNT.isin(countries), ]
 
-# REPLACE COUNTRY NAMES
-df['CNT'] = df.loc[:, 'CNT'].replace(to_replace=country_values)
+def get_country_ranges(index, selected):
+    """Return the ranges of lines of the selected countries in file order.
 
-# REPLACE USAGE VALUES
-df.loc[:, 'IC01Q01':'IC02Q07'] = df.loc[:, 'IC01Q01':'IC02Q07'].replace(
-    to_replace=usage_values)
+    Adjacent ranges are merged into one. Without any lines an empty range
+    is returned, so the tableau data still gets its header.
+    """
+    ranges = []
+    for start, end, first_row in sorted(
+            tuple(lines) for country in selected
+            for lines in index['countries'].get(country, [])):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end, first_row])
+    return ranges or [[0, 0, 0]]
 
-# REPLACE TIME INFORMATION
-df.loc[:, 'IC10Q01':'IC10Q09'] = df.loc[:, 'IC10Q01':'IC10Q09'].replace(
-    to_replace=time_values)
 
-# CONVERT COLUMNS TO FLOAT
-df[cols[2:]] = df[cols[2:]].apply(pd.to_numeric)
+def filter_countries(df, selected):
+    """Return the rows of the selected countries."""
+    return df.loc[df.CNT.isin(selected), ]
 
-# CREATE COLUMN FOR 'DOES THE STUDENT HAS ACCESS TO ICT AT HOME?'
-df['ict_avail_home'] = df.loc[:, 'IC01Q01':'IC01Q11'].max(axis=1).replace(
-    to_replace=2.0, value=1.0)
 
-# CREATE COLUMN FOR 'DOES THE STUDENT HAS ACCESS TO ICT AT SCHOOL?'
-df['ict_avail_school'] = df.loc[:, 'IC02Q01':'IC02Q07'].max(axis=1).replace(
-    to_replace=2.0, value=1.0)
+def recode(df, columns):
+    """Return the decoded blocks of input columns the columns need."""
+    blocks = {column_blocks[column] for column in columns}
+    recoded = {}
+
+    # REPLACE COUNTRY NAMES, ONCE PER CATEGORY
+    if 'CNT' in blocks:
+        names = np.array(
+            [country_values.get(name, name) for name in df.CNT.cat.categories],
+            dtype=object)
+        recoded['CNT'] = names[df.CNT.cat.codes.values]
+    if 'OECD' in blocks:
+        recoded['OECD'] = df.OECD.values
+    if weight_col in blocks:
+        recoded[weight_col] = df[weight_col].values
+
+    # DECODE USAGE AND TIME VALUES
+    for block, coding in (('IC01', usage_values), ('IC02', usage_values),
+                          ('IC10', time_values)):
+        if block in blocks:
+            recoded[block] = decode_columns(df, block, coding)
+
+    # PLAUSIBLE VALUES ARE READ AS FLOAT ALREADY
+    for block in ('MATH', 'READ', 'SCIE'):
+        if block in blocks:
+            recoded[block] = df[get_block_columns(block)]
+    return recoded
+
+
+def derive_ict(recoded):
+    """Return all ict_* columns, reducing every decoded block only once."""
+    ict = {}
+    for block, place in (('IC01', 'home'), ('IC02', 'school')):
+        if block in recoded:
+            # THE HIGHEST USAGE CODE IS SHARED BY AVAILABILITY AND USAGE,
+            # MISSING (-1) TAKES THE LAST VALUE
+            highest = recoded[block].max(axis=0)
+
+            # DOES THE STUDENT HAS ACCESS TO ICT AT HOME/SCHOOL?
+            ict['ict_avail_' + place] = avail_values[highest]
+
+            # DOES THE STUDENT USE THE ICT HE HAS ACCESS TO AT HOME/SCHOOL?
+            ict['ict_used_' + place] = used_values[highest]
+
+    # HOW LONG DOES THE STUDENT USE ICT AT SCHOOL ON AVERAGE?
+    if 'IC10' in recoded:
+        ict['ict_usage_time_school'] = time_categories[get_mean_code(
+            recoded['IC10'])]
+    return ict
+
+
+def derive(recoded, columns):
+    """Return the tableau data of the given columns from decoded blocks."""
+    derived = derive_ict(recoded)
+    for column in columns:
+        block = column_blocks[column]
+        if column.endswith('_score'):
+            # AVERAGE MATH, READING AND SCIENCE SCORES
+            derived[column] = recoded[block].mean(axis=1).values
+        elif column not in derived:
+            derived[column] = recoded[block]
+    return pd.DataFrame({column: derived[column] for column in columns})
+
+
+def transform(df, selected=None, columns=None):
+    """Return the tableau data of the given pisa rows.
+
+    Only rows of the selected countries, all of countries by default, are
+    kept and only the given columns are derived, all by default.
+    """
+    if selected is None:
+        selected = countries
+    if columns is None:
+        columns = tableau_columns
+    df = filter_countries(df, selected)
+    return derive(recode(df, columns), columns)
+
+
+def get_transform_version():
+    """Return a hash of the code and codings transform() depends on.
+
+    The names of the countries are left out, get_partition_key() holds the
+    name of each country so renaming one only recomputes its partition.
+    """
+    sha1 = hashlib.sha1()
+    for function in (get_block_columns, decode, decode_columns,
+                     get_mean_code, filter_countries, recode, derive_ict,
+                     derive, transform):
+        sha1.update(inspect.getsource(function).encode())
+    for constant in (cols, weight_col, col_types, usage_values, time_values,
+                     missing_code, avail_values, used_values,
+                     time_categories, column_blocks, tableau_columns):
+        sha1.update(repr(constant).encode())
+    return sha1.hexdigest()
+
+
+def get_partition_key(country):
+    """Return everything the tableau data of a country depends on."""
+    return {
+        'version': get_transform_version(),
+        'name': country_values.get(country, country)
+    }
+
+
+def read_manifest(directory):
+    """Return the manifest of the partitions or an empty one."""
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {'input': None, 'partitions': {}}
+
+
+def update_partitions(file_name, directory, chunksize=None, index=None):
+    """Regenerate the partitions of all countries which are out of date.
+
+    Every country of the database has its own csv file in directory. The
+    manifest records the database it was generated from and the key of
+    each partition, so only new countries and countries whose key changed
+    are read and transformed again. Given the index of the database, only
+    their lines are parsed.
+
+    The partitions are concatenated in the order of their first rows, so
+    the rows of every country must follow each other in the database,
+    otherwise a ValueError is raised.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    fingerprint = get_fingerprint(file_name)
+
+    # KEEP THE PARTITIONS WHICH ARE STILL UP TO DATE
+    partitions = {}
+    for country, partition in manifest['partitions'].items():
+        if (manifest['input'] == fingerprint and country in countries
+                and partition['key'] == get_partition_key(country)):
+            partitions[country] = partition
+        else:
+            os.remove(os.path.join(directory, partition['file']))
+    stale = [country for country in countries if country not in partitions]
+
+    if stale:
+        # A MANIFEST IS ONLY LEFT BEHIND ONCE ALL PARTITIONS ARE COMPLETE
+        if os.path.exists(os.path.join(directory, 'manifest.json')):
+            os.remove(os.path.join(directory, 'manifest.json'))
+
+        # APPEND THE ROWS OF EVERY CHUNK TO THE PARTITION OF THEIR COUNTRY
+        next_rows = {}
+        if index is None:
+            chunks = read_pisa(file_name, chunksize)
+        else:
+            chunks = read_ranges(
+                file_name, get_country_ranges(index, stale),
+                chunksize=chunksize)
+        for chunk in chunks:
+            chunk = chunk.loc[chunk.CNT.isin(stale), ]
+            for country, rows in chunk.groupby('CNT', observed=True,
+                                               sort=False):
+                first_row, last_row = int(rows.index[0]), int(rows.index[-1])
+                if (last_row - first_row + 1 != len(rows)
+                        or next_rows.get(country, first_row) != first_row):
+                    raise ValueError(
+                        'The rows of {} are not contiguous in {}'.format(
+                            country, file_name))
+                next_rows[country] = last_row + 1
+                if country not in partitions:
+                    partitions[country] = {
+                        'file': re.sub(r'\W', '_', country) + '.csv',
+                        'key': get_partition_key(country),
+                        'first_row': first_row
+                    }
+                    mode = 'w'
+                else:
+                    mode = 'a'
+                transform(rows).to_csv(
+                    os.path.join(directory, partitions[country]['file']),
+                    index=False, encoding='utf-8', mode=mode,
+                    header=mode == 'w')
+
+        # COUNTRIES WITHOUT ROWS GET AN EMPTY PARTITION
+        for country in stale:
+            if country not in partitions:
+                partitions[country] = {
+                    'file': re.sub(r'\W', '_', country) + '.csv',
+                    'key': get_partition_key(country),
+                    'first_row': None
+                }
+                transform(read_range(file_name, 0, 0)).to_csv(
+                    os.path.join(directory, partitions[country]['file']),
+                    index=False, encoding='utf-8')
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as manifest:
+        json.dump({'input': fingerprint, 'partitions': partitions},
+                  manifest, indent=2)
+    return partitions
+
+
+def read_partition(file_name):
+    """Return the tableau data of a partition."""
+    return pd.read_csv(
+        file_name, encoding='utf-8', float_precision='round_trip',
+        dtype={
+            'country': 'str',
+            'oecd': 'str',
+            'ict_usage_time_school': 'str'
+        })
+
+
+def assemble_partitions(partitions, directory, file_name, file_format='csv'):
+    """Concatenate the partitions in the order of the database."""
+    ordered = sorted(
+        partitions.values(),
+        key=lambda partition: (partition['first_row'] is None,
+                               partition['first_row']))
+    if file_format != 'csv':
+        writer = writers[file_format]
+        writer['write'](
+            (writer['encode'](read_partition(
+                os.path.join(directory, partition['file'])), number == 0)
+             for number, partition in enumerate(ordered)), file_name)
+        return
+
+    with open(file_name, 'wb') as output:
+        for number, partition in enumerate(ordered):
+            with open(os.path.join(directory, partition['file']),
+                      'rb') as part:
+                # ONLY KEEP THE HEADER OF THE FIRST PARTITION
+                header = part.readline()
+                if number == 0:
+                    output.write(header)
+                shutil.copyfileobj(part, output)
+
+
+# WRITERS BY FORMAT, ENCODING THE TABLEAU DATA OF EVERY CHUNK AND WRITING
+# THE ENCODED CHUNKS
+writers = {'csv': {'encode': encode_csv, 'write': write_csv}}
+if importlib.util.find_spec('pyarrow') is not None:
+    writers['parquet'] = {'encode': encode_parquet, 'write': write_parquet}
+
+
+def scan(file_name='pisa2012.csv', chunksize=None, index=None):
+    """Return a lazy plan converting the pisa database.
+
+    Nothing is read until the plan is run by execute(), collect() or
+    write(). Given the index of the database, only the lines of the
+    selected countries are parsed.
+    """
+    return {
+        'input': file_name,
+        'chunksize': chunksize,
+        'index': index,
+        'countries': None,
+        'columns': None
+    }
+
+
+def where_countries(plan, selected):
+    """Return the plan keeping only rows of the selected countries."""
+    return dict(plan, countries=list(selected))
+
+
+def project(plan, columns):
+    """Return the plan deriving only the given columns."""
+    unknown = [column for column in columns if column not in column_blocks]
+    if unknown:
+        raise ValueError('Unknown columns: {}'.format(', '.join(unknown)))
+    return dict(plan, columns=list(columns))
+
+
+def get_selection(plan):
+    """Return the countries and columns selected by a plan."""
+    selected = countries if plan['countries'] is None else plan['countries']
+    columns = tableau_columns if plan['columns'] is None else plan['columns']
+    return selected, columns
+
+
+def execute(plan):
+    """Return the tableau data of a plan chunk by chunk.
+
+    Only the input columns the selected columns are derived from are
+    parsed.
+    """
+    selected, columns = get_selection(plan)
+    usecols = get_input_columns(columns)
+    if plan['index'] is None:
+        chunks = read_pisa(plan['input'], plan['chunksize'], usecols)
+    else:
+        chunks = read_ranges(
+            plan['input'], get_country_ranges(plan['index'], selected),
+            usecols, plan['chunksize'])
+    for chunk in chunks:
+        yield transform(chunk, selected, columns)
+
+
+def collect(plan):
+    """Return the tableau data of a plan as one DataFrame."""
+    return pd.concat(list(execute(plan)), ignore_index=True)
+
+
+def get_plan_ranges(plan, jobs):
+    """Return the ranges of lines of a plan to convert in jobs processes."""
+    if plan['index'] is None:
+        return get_byte_ranges(plan['input'], jobs)
+    return get_country_ranges(plan['index'], get_selection(plan)[0])
+
+
+def write(plan, file_name, file_format='csv', jobs=1):
+    """Write the tableau data of a plan in the given format.
+
+    With more than one job, ranges of the database are converted in that
+    many processes.
+    """
+    writer = writers[file_format]
+    if jobs > 1:
+        # ENCODE EVERY RANGE IN A JOB AND WRITE THEM IN THE ORDER OF THE
+        # DATABASE
+        selected, columns = get_selection(plan)
+        ranges = get_plan_ranges(plan, jobs)
+        with ProcessPoolExecutor(jobs) as executor:
+            writer['write'](executor.map(
+                transform_range, [plan['input']] * len(ranges),
+                [lines[0] for lines in ranges],
+                [lines[1] for lines in ranges],
+                [number == 0 for number in range(len(ranges))],
+                [file_format] * len(ranges), [selected] * len(ranges),
+                [columns] * len(ranges)), file_name)
+        return
+
+    # WRITE OUT EVERY CHUNK AFTER THE OTHER
+    writer['write']((writer['encode'](chunk, number == 0)
+                     for number, chunk in enumerate(execute(plan))),
+                    file_name)
+
+
+def get_cube(df):
+    """Return the cube of tableau data holding the weight of every student.
+
+    Every combination of the dimensions, missing values included, holds
+    the number of students, their total weight and the weighted sums and
+    sums of squares of the scores. They add up over any dimension, so the
+    weighted mean is sum / weight and the variance sumsq / weight minus
+    the squared mean.
+    """
+    measures = pd.DataFrame(
+        {'students': 1, 'weight': df.weight.values}, index=df.index)
+    for score in cube_scores:
+        weighted = df.weight.values * df[score].values
+        measures[score + '_sum'] = weighted
+        measures[score + '_sumsq'] = weighted * df[score].values
+    return measures.groupby(
+        [df[dimension] for dimension in cube_dimensions], dropna=False,
+        observed=True).sum()
+
+
+def merge_cubes(cubes):
+    """Return the sum of several cubes as one table."""
+    cube = pd.concat(cubes)
+    return cube.groupby(
+        level=cube_dimensions, dropna=False, observed=True).sum().reset_index()
+
+
+def aggregate_range(file_name, start, end, selected):
+    """Return the cube of a range of lines."""
+    columns = cube_dimensions + cube_scores + ['weight']
+    df = read_range(file_name, start, end, usecols=get_input_columns(columns))
+    return get_cube(transform(df, selected, columns))
+
+
+def aggregate(plan, jobs=1):
+    """Return the weighted aggregate cube of the tableau data of a plan.
+
+    The cube is built chunk by chunk, or range by range in jobs processes,
+    and the partial cubes are summed up.
+    """
+    plan = project(plan, cube_dimensions + cube_scores + ['weight'])
+    if jobs > 1:
+        ranges = get_plan_ranges(plan, jobs)
+        with ProcessPoolExecutor(jobs) as executor:
+            cubes = list(executor.map(
+                aggregate_range, [plan['input']] * len(ranges),
+                [lines[0] for lines in ranges],
+                [lines[1] for lines in ranges],
+                [get_selection(plan)[0]] * len(ranges)))
+    else:
+        cubes = [get_cube(chunk) for chunk in execute(plan)]
+    return merge_cubes(cubes)
 
-# CREATE COLUMN FOR 'DOES THE STUDENT USE THE ICT HE HAS ACCESS TO AT HOME?'
-df['ict_used_home'] = df.loc[:, 'IC01Q01':'IC01Q11'].max(axis=1).replace(
-    to_replace=1.0, value=0.0).replace(to_replace=2.0, value=1.0)
 
-# CREATE COLUMN FOR 'DOES THE STUDENT USE THE ICT HE HAS ACCESS TO AT SCHOOL?'
-df['ict_used_school'] = df.loc[:, 'IC02Q01':'IC02Q07'].max(axis=1).replace(
-    to_replace=1.0, value=0.0).replace(to_replace=2.0, value=1.0)
+def parse_arguments():
+    """Return the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--input', default='pisa2012.csv', help='the pisa 2012 database')
+    parser.add_argument(
+        '--output',
+        help='the tableau data to write, tableau.csv or tableau.parquet by '
+        'default, tableau_cube.csv or tableau_cube.parquet if aggregated')
+    parser.add_argument(
+        '--format', default='csv', choices=sorted(writers),
+        help='the format of the tableau data, parquet needs pyarrow')
+    parser.add_argument(
+        '--chunksize', type=int,
+        help='process the database in chunks of this many rows, so the '
+        'memory needed does not grow with the size of the database')
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='process ranges of the database in this many processes')
+    parser.add_argument(
+        '--partitions',
+        help='keep the tableau data of every country in this directory and '
+        'only regenerate the countries which changed')
+    parser.add_argument(
+        '--index',
+        help='the index of the lines of every country in the database, so '
+        'only the lines of the selected countries are parsed. It is built '
+        'if it does not exist or the database changed.')
+    parser.add_argument(
+        '--aggregate', action='store_true',
+        help='write the weighted scores of all students aggregated by '
+        'country, oecd and the ict columns instead of one row per student')
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = ('tableau_cube.' if args.aggregate else
+                       'tableau.') + args.format
+    if args.partitions and (args.jobs > 1 or args.aggregate):
+        parser.error('--partitions cannot be combined with --jobs or '
+                     '--aggregate')
+    return args
 
-# CREATE COLUMN FOR 'HOW LONG DOES THE STUDENT USE ICT AT SCHOOL ON AVERAGE?'
-df['ict_usage_time_school'] = df.loc[:, 'IC10Q01':'IC10Q09'].mean(
-    axis=1).round().apply(return_time_category)
 
-# CREATE COLUMN FOR AVERAGE MATH SCORE
-df['math_score'] = df.loc[:, 'PV1MATH':'PV5MATH'].mean(axis=1)
+def main():
+    """Convert the pisa 2012 database into the tableau data."""
+    args = parse_arguments()
+    index = None
+    if args.index:
+        index = load_index(args.input, args.index)
 
-# CREATE COLUMN FOR AVERAGE READING SCORE
-df['read_score'] = df.loc[:, 'PV1READ':'PV5READ'].mean(axis=1)
+    if args.partitions:
+        # REGENERATE THE CHANGED COUNTRIES AND REASSEMBLE THE CSV
+        partitions = update_partitions(
+            args.input, args.partitions, args.chunksize, index)
+        assemble_partitions(
+            partitions, args.partitions, args.output, args.format)
+        return
 
-# CREATE COLUMN FOR AVERAGE SCIENCE SCORE
-df['scie_score'] = df.loc[:, 'PV1SCIE':'PV5SCIE'].mean(axis=1)
+    plan = scan(args.input, args.chunksize, index)
+    if args.aggregate:
+        writer = writers[args.format]
+        writer['write'](
+            [writer['encode'](aggregate(plan, args.jobs), True)], args.output)
+        return
 
-# DROP COLUMNS
-df.drop(columns=cols[2:], inplace=True)
+    write(plan, args.output, args.format, args.jobs)
 
-# RENAME COLUMNS
-df.rename(index=str, columns={'CNT': 'Country'}, inplace=True)
-df.rename(str.lower, axis='columns', inplace=True)
 
-# WRITE OUT CSV
-df.to_csv('tableau.csv', index=False, encoding='utf-8')
+if __name__ == '__main__':
+    main()